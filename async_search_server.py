@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+import asyncio
+import getopt
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import vectorized
+from search import init_worker, answer_in_worker, POSTINGS_CACHE_BYTES, RESULT_CACHE_BYTES
+
+"""
+    asyncio front end serving queries to many concurrent connections, with the line protocol of search_server.py.
+    The event loop only reads queries and writes answers. Queries are parsed and evaluated in a pool of worker
+    processes, each of which loads the index (and maps posting.txt) once and keeps its own caches, so neither
+    evaluation nor reading posting lists ever blocks the event loop, and evaluations run on every CPU.
+    - Answers are written in the order the queries were received on each connection, while up to PIPELINE_DEPTH
+      queries of a connection are evaluated concurrently.
+    - Backpressure: at most max_pending queries are queued or evaluated in the pool at once. Beyond that, and once
+      a connection has PIPELINE_DEPTH queries in flight, its socket is no longer read, which in turn blocks the
+      client. Answers are only written as fast as the client reads them (StreamWriter.drain).
+    - Timeouts: a query not answered within the time limit is answered with `!timeout`. A query that has not
+      started yet is dropped from the pool, but a running one can not be interrupted in the worker. It keeps its
+      slot until it is done, so that timed out queries can not pile up in the pool.
+    - A query which fails to parse is answered with `!error <message>`.
+    `!batch n` is accepted for compatibility with search_server.py, and simply ignored, since every query is
+    pipelined anyway. `!stats`, `!quit` and `!shutdown` behave as in search_server.py.
+"""
+
+# Maximum number of queries of a single connection in flight
+PIPELINE_DEPTH = 64
+# Default maximum number of queries queued or evaluated in the worker pool, per worker
+MAX_PENDING_PER_WORKER = 16
+# Default time limit of a query in seconds
+QUERY_TIMEOUT = 10.0
+# Connections waiting to be accepted. asyncio defaults to 100, and further clients connecting at once are refused
+LISTEN_BACKLOG = 1024
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file (-s socket-file | -t port) [-j workers]"
+          " [-l query-time-limit-seconds] [-m max-pending-queries] [-e python|numpy] [-c posting-list-cache-bytes]"
+          " [-r result-cache-bytes]")
+
+
+class AsyncSearchServer:
+    def __init__(self, pool, max_pending, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max_pending)
+        self.stopped = asyncio.Event()
+        self.num_connections = 0
+        self.num_queries = 0
+        self.num_timeouts = 0
+        self.num_errors = 0
+
+    async def answer(self, query):
+        loop = asyncio.get_event_loop()
+        self.num_queries += 1
+        await self.slots.acquire()
+        future = self.pool.submit(answer_in_worker, query)
+        # The slot is released once the worker is done with the query, even if it timed out
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.slots.release))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.num_timeouts += 1
+            return "!timeout\n"
+        except Exception as e:
+            self.num_errors += 1
+            return "!error {}\n".format(str(e).replace("\n", " "))
+
+    def get_stats(self):
+        return "{} open connections, {} queries, {} timeouts, {} errors\n".format(
+            self.num_connections, self.num_queries, self.num_timeouts, self.num_errors)
+
+    async def write_answers(self, answers, writer):
+        while True:
+            answer = await answers.get()
+            if answer is None:
+                return
+            writer.write((await answer).encode("utf-8"))
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        self.num_connections += 1
+        # Answers in the order of the queries. Once full, the connection is not read until an answer is written
+        answers = asyncio.Queue(PIPELINE_DEPTH)
+        writer_task = asyncio.ensure_future(self.write_answers(answers, writer))
+        shutdown = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8")
+                command = line.strip()
+                if command.startswith("!batch"):
+                    continue
+                elif command == "!quit":
+                    break
+                elif command == "!shutdown":
+                    shutdown = True
+                    break
+                elif command == "!stats":
+                    answer = asyncio.Future()
+                    answer.set_result(self.get_stats())
+                else:
+                    answer = asyncio.ensure_future(self.answer(line))
+                await answers.put(answer)
+            await answers.put(None)
+            await writer_task
+        except ConnectionError:
+            writer_task.cancel()
+        finally:
+            writer.close()
+            self.num_connections -= 1
+            # The server stops once the queries before !shutdown are answered
+            if shutdown:
+                self.stopped.set()
+
+
+async def serve(search_server, socket_file, port):
+    if socket_file != None:
+        server = await asyncio.start_unix_server(search_server.handle_connection, path=socket_file,
+                                                 backlog=LISTEN_BACKLOG)
+    else:
+        server = await asyncio.start_server(search_server.handle_connection, host="127.0.0.1", port=port,
+                                            backlog=LISTEN_BACKLOG)
+    print("Serving on {}".format(socket_file if socket_file != None else ("127.0.0.1", port)), file=sys.stderr)
+    await search_server.stopped.wait()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == '__main__':
+    dictionary_file = postings_file = socket_file = port = None
+    num_workers = os.cpu_count() or 1
+    timeout = QUERY_TIMEOUT
+    max_pending = None
+    engine = "python"
+    cache_bytes = POSTINGS_CACHE_BYTES
+    result_cache_bytes = RESULT_CACHE_BYTES
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:s:t:j:l:m:e:c:r:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-s':
+            socket_file = a
+        elif o == '-t':
+            port = int(a)
+        elif o == '-j':
+            num_workers = int(a)
+        elif o == '-l':
+            timeout = float(a)
+        elif o == '-m':
+            max_pending = int(a)
+        elif o == '-e':
+            engine = a
+        elif o == '-c':
+            cache_bytes = int(a)
+        elif o == '-r':
+            result_cache_bytes = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None or (socket_file == None) == (port == None):
+        usage()
+        sys.exit(2)
+
+    if engine not in ["python", "numpy"] or (engine == "numpy" and vectorized.np is None) or num_workers < 1:
+        usage()
+        sys.exit(2)
+
+    if max_pending == None:
+        max_pending = num_workers * MAX_PENDING_PER_WORKER
+
+    if socket_file != None and os.path.exists(socket_file):
+        os.remove(socket_file)
+
+    pool = ProcessPoolExecutor(num_workers, initializer=init_worker,
+                               initargs=(dictionary_file, postings_file, engine, cache_bytes, result_cache_bytes))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    search_server = AsyncSearchServer(pool, max_pending, timeout)
+    try:
+        loop.run_until_complete(serve(search_server, socket_file, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Queries still running release their slot on the loop once done, so the pool is shut down first
+        pool.shutdown(cancel_futures=True)
+        loop.close()
+        if socket_file != None and os.path.exists(socket_file):
+            os.remove(socket_file)
+        print(search_server.get_stats(), end="", file=sys.stderr)
@@ -0,0 +1,578 @@
+#!/usr/bin/python3
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from collections import defaultdict
+from queue import PriorityQueue
+from math import ceil, log, sqrt
+from nltk.stem.porter import PorterStemmer
+
+from inverted_index import InvertedIndex
+from query import merge_or, merge_or_all, intersect, intersect_all, difference, QueryParser
+from tokenizer import nltk_tokenize, regex_tokenize
+
+"""
+    Benchmarks for the indexing and searching steps.
+    Each benchmark compares the current implementation against the one it replaced.
+"""
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -b benchmark [-i directory-of-documents] [-d dictionary-file -p postings-file]")
+    print("indexing benchmarks (-i): " + ", ".join(INDEX_BENCHMARKS))
+    print("searching benchmarks (-d, -p): " + ", ".join(SEARCH_BENCHMARKS))
+
+
+def read_term_stream(in_dir):
+    """
+        Returns the (term, doc_id) pairs of every document in in_dir, exactly as construct_index sees them
+    """
+    inverted_index_class = InvertedIndex(in_dir)
+    stemmer = PorterStemmer()
+    stem_dict = {}
+
+    doc_ids = sorted([int(doc_id) for doc_id in os.listdir(in_dir)])
+    stream = []
+    for doc_id in doc_ids:
+        for term in inverted_index_class.read_terms(doc_id, stemmer, stem_dict):
+            stream.append((term, doc_id))
+    return stream
+
+
+def invert_with_list_scan(stream, block_bytes):
+    """
+        SPIMI inversion as previously done in construct_index, checking `doc_id not in postings[term]`.
+        Blocks are flushed on the memory estimate of build_blocks.
+    """
+    postings = defaultdict(list)
+    curr_bytes_in_mem = 0
+    for term, doc_id in stream:
+        if term not in postings:
+            curr_bytes_in_mem += InvertedIndex.TERM_BYTES
+        if doc_id not in postings[term]:
+            postings[term].append(doc_id)
+            curr_bytes_in_mem += InvertedIndex.POSTING_BYTES
+        if curr_bytes_in_mem >= block_bytes:
+            curr_bytes_in_mem = 0
+            postings = defaultdict(list)
+
+
+def invert_with_last_doc_check(stream, block_bytes):
+    """
+        SPIMI inversion as done in build_blocks, only comparing against the last doc id of the posting list
+    """
+    postings = defaultdict(list)
+    curr_bytes_in_mem = 0
+    for term, doc_id in stream:
+        if term not in postings:
+            curr_bytes_in_mem += InvertedIndex.TERM_BYTES
+        posting_list = postings[term]
+        if len(posting_list) == 0 or posting_list[-1] != doc_id:
+            posting_list.append(doc_id)
+            curr_bytes_in_mem += InvertedIndex.POSTING_BYTES
+        if curr_bytes_in_mem >= block_bytes:
+            curr_bytes_in_mem = 0
+            postings = defaultdict(list)
+
+
+def benchmark_inversion(in_dir):
+    print("Tokenizing {} ...".format(in_dir))
+    stream = read_term_stream(in_dir)
+    print("{} tokens".format(len(stream)))
+
+    # Small blocks, and blocks of the default budget of build_blocks
+    for block_bytes in [1024 * 1024, InvertedIndex.BLOCK_BYTES]:
+        start_time = time.perf_counter()
+        invert_with_list_scan(stream, block_bytes)
+        list_scan_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        invert_with_last_doc_check(stream, block_bytes)
+        last_doc_time = time.perf_counter() - start_time
+
+        print("Blocks of {}MB: list scan {:.2f}s, last doc check {:.2f}s ({:.1f}x)".format(
+            block_bytes // (1024 * 1024), list_scan_time, last_doc_time, list_scan_time / last_doc_time))
+
+
+def benchmark_merge(in_dir):
+    in_dir = os.path.abspath(in_dir)
+    # Blocks are written to blocks/ in the working directory
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    inverted_index_class = InvertedIndex(in_dir)
+    os.makedirs("blocks")
+    # Small blocks, so that there are hundreds of them
+    num_blocks = inverted_index_class.build_blocks(sorted([int(doc_id) for doc_id in os.listdir(in_dir)]),
+                                                   block_bytes=96 * 1024)
+    shutil.copytree("blocks", "built-blocks")
+
+    postings = None
+    for fan_in in [num_blocks, 64, 16, 4]:
+        shutil.rmtree("blocks")
+        shutil.copytree("built-blocks", "blocks")
+        for out_file in [inverted_index_class.out_dict, inverted_index_class.out_postings]:
+            if os.path.exists(out_file):
+                os.remove(out_file)
+
+        start_time = time.perf_counter()
+        inverted_index_class.merge_blocks(num_blocks, fan_in)
+        merge_time = time.perf_counter() - start_time
+
+        with open(inverted_index_class.out_postings, 'rb') as f:
+            merged_postings = f.read()
+        if postings == None:
+            postings = merged_postings
+        assert merged_postings == postings
+        num_passes = max(1, ceil(log(num_blocks) / log(fan_in)))
+        print("{} blocks, fan-in {}: {} passes in {:.2f}s, at most {} block files open".format(
+            num_blocks, fan_in, num_passes, merge_time, min(fan_in, num_blocks)))
+
+    shutil.rmtree(work_dir)
+
+
+class QueueItem:
+    def __init__(self, line, block_num):
+        line = line.rstrip('\n').strip(' ')
+        split_line = line.split(" ")
+        self.term = split_line[0]  # What is the term
+        self.posting_list = line.split(" ")[1:]  # Remove first item
+        self.block_num = block_num  # Tell us what block file this item comes from
+
+    def get_term(self):
+        return self.term
+
+    def get_posting_list(self):
+        return self.posting_list
+
+    def get_block_num(self):
+        return int(self.block_num)
+
+    # We compare by term values first. If two items have the same term values, then we will
+    # compare their block number.
+    def __eq__(self, other):
+        return ((self.term, int(self.block_num)) == (other.get_term(), other.get_block_num()))
+
+    def __ne__(self, other):
+        return ((self.term, int(self.block_num)) != (other.get_term(), other.get_block_num()))
+
+    def __lt__(self, other):
+        return ((self.term, int(self.block_num)) < (other.get_term(), other.get_block_num()))
+
+    def __le__(self, other):
+        return ((self.term, int(self.block_num)) <= (other.get_term(), other.get_block_num()))
+
+    def __gt__(self, other):
+        return ((self.term, int(self.block_num)) > (other.get_term(), other.get_block_num()))
+
+    def __ge__(self, other):
+        return ((self.term, int(self.block_num)) >= (other.get_term(), other.get_block_num()))
+
+    def __repr__(self):
+        return "%s %s" % (self.term, int(self.block_num))
+
+
+def merge_with_priority_queue(block_files):
+    """
+        The k-way merge of InvertedIndex.merge_block_files before it used heapq.merge: a PriorityQueue of QueueItems
+    """
+    readers = [open(block_file, 'r', buffering=InvertedIndex.BLOCK_BUFFER_BYTES) for block_file in block_files]
+    q = PriorityQueue()
+    for block_num, reader in enumerate(readers):
+        line = reader.readline()
+        if line:
+            q.put(QueueItem(line, block_num))
+
+    term_to_write = None
+    doc_ids_to_write = []
+    while not q.empty():
+        curr_item = q.get()
+        curr_term = curr_item.get_term()
+        curr_block = curr_item.get_block_num()
+        if curr_term != term_to_write:
+            if term_to_write != None:
+                yield term_to_write, doc_ids_to_write
+            term_to_write = curr_term
+            doc_ids_to_write = []
+
+        for doc_id in curr_item.get_posting_list():
+            doc_id = int(doc_id)
+            if len(doc_ids_to_write) == 0 or doc_id != doc_ids_to_write[-1]:
+                doc_ids_to_write.append(doc_id)
+
+        line = readers[curr_block].readline()
+        if line:
+            q.put(QueueItem(line, curr_block))
+
+    if term_to_write != None:
+        yield term_to_write, doc_ids_to_write
+    for reader in readers:
+        reader.close()
+
+
+def benchmark_merge_queue(in_dir):
+    in_dir = os.path.abspath(in_dir)
+    # Blocks are written to blocks/ in the working directory
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    inverted_index_class = InvertedIndex(in_dir)
+    os.makedirs("blocks")
+    # Blocks of 1MB, a dozen or so of them
+    num_blocks = inverted_index_class.build_blocks(sorted([int(doc_id) for doc_id in os.listdir(in_dir)]),
+                                                   block_bytes=1024 * 1024)
+    block_files = ["blocks/" + str(block_num) for block_num in range(num_blocks)]
+
+    results = {}
+    for name, merge_blocks in [("PriorityQueue of QueueItems", merge_with_priority_queue),
+                               ("heapq.merge of tuples", inverted_index_class.merge_block_files)]:
+        start_time = time.perf_counter()
+        results[name] = list(merge_blocks(block_files))
+        merge_time = time.perf_counter() - start_time
+        num_postings = sum([len(doc_ids) for term, doc_ids in results[name]])
+        print("{} blocks, {}: {} postings in {:.2f}s ({:.0f} postings/s)".format(
+            num_blocks, name, num_postings, merge_time, num_postings / merge_time))
+    assert len(set([str(result) for result in results.values()])) == 1
+
+    shutil.rmtree(work_dir)
+
+
+def read_lines(in_dir):
+    """
+        Returns the lines of every document in in_dir as a list of (doc_id, list of lines)
+    """
+    docs = []
+    for doc_id in sorted([int(doc_id) for doc_id in os.listdir(in_dir)]):
+        with open(os.path.join(in_dir, str(doc_id))) as file:
+            docs.append((doc_id, file.readlines()))
+    return docs
+
+
+def tokenize_docs(docs, tokenize):
+    """
+        Tokenizes every line of docs, dropping empty words as read_terms does
+    """
+    return [[w_token for line in lines for w_token in tokenize(line) if len(w_token) > 0] for doc_id, lines in docs]
+
+
+def benchmark_tokenizer(in_dir):
+    docs = read_lines(in_dir)
+    print("{} documents".format(len(docs)))
+
+    start_time = time.perf_counter()
+    nltk_words = tokenize_docs(docs, nltk_tokenize)
+    nltk_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    regex_words = tokenize_docs(docs, regex_tokenize)
+    regex_time = time.perf_counter() - start_time
+
+    # The regex tokenizer must produce exactly the same words, or the index would change
+    num_different = 0
+    for (doc_id, lines), expected, actual in zip(docs, nltk_words, regex_words):
+        if expected != actual:
+            num_different += 1
+            if num_different <= 5:
+                print("Doc {} differs:\n  nltk:  {}\n  regex: {}".format(doc_id, expected, actual))
+
+    print("{} words, {} documents with different words".format(sum(map(len, nltk_words)), num_different))
+    print("nltk {:.2f}s, regex {:.2f}s ({:.1f}x)".format(nltk_time, regex_time, nltk_time / regex_time))
+
+
+def read_terms_by_doc_freq(dict_file, num_terms):
+    """
+        Returns the num_terms terms of dict_file with the largest posting lists
+    """
+    with open(dict_file) as f:
+        entries = [line.split() for line in f]
+    entries = sorted(entries, key=lambda entry: int(entry[1]), reverse=True)
+    return [entry[0] for entry in entries[:num_terms]]
+
+
+def union_by_folding(lists):
+    """
+        Union as previously done in QueryOr.evaluate, merging the operands pairwise
+    """
+    union = lists[0]
+    for l in lists[1:]:
+        union = merge_or(union, l)
+    return union
+
+
+def benchmark_or(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    # Frequent terms, as in the generated queries, since rare terms make any union cheap
+    terms = read_terms_by_doc_freq(dict_file, 1000)
+    rng = random.Random(3245)
+
+    for num_ops in [2, 4, 8, 16, 32, 64]:
+        queries = [[inverted_index_class.get_posting_list_for_term(term) for term in rng.sample(terms, num_ops)]
+                   for _ in range(100)]
+
+        start_time = time.perf_counter()
+        folded = [union_by_folding(lists) for lists in queries]
+        fold_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        merged = [merge_or_all(lists) for lists in queries]
+        merge_time = time.perf_counter() - start_time
+
+        assert folded == merged
+        print("{} operands: pairwise {:.3f}s, k-way {:.3f}s ({:.1f}x)".format(
+            num_ops, fold_time, merge_time, fold_time / merge_time))
+
+    inverted_index_class.close()
+
+
+def intersect_with_skips(l1, l2):
+    """
+        Intersection as previously done in QueryAnd.evaluate, rebuilding skip pointers every ceil(sqrt(n)) docs
+        and merging both lists with them
+    """
+    jump_1 = ceil(sqrt(len(l1)))
+    jump_2 = ceil(sqrt(len(l2)))
+    i = j = 0
+    out = []
+    while i < len(l1) and j < len(l2):
+        if l1[i] == l2[j]:
+            out.append(l1[i])
+            i += 1
+            j += 1
+        elif l1[i] < l2[j]:
+            if i % jump_1 == 0 and i + jump_1 < len(l1) and l1[i + jump_1] < l2[j]:
+                i += jump_1
+            else:
+                i += 1
+        else:
+            if j % jump_2 == 0 and j + jump_2 < len(l2) and l2[j + jump_2] < l1[i]:
+                j += jump_2
+            else:
+                j += 1
+    return out
+
+
+def sample_term_pairs(dict_file, ratio, rng):
+    """
+        Returns 200 pairs of a rare term and a common term whose posting list is ratio times larger
+    """
+    with open(dict_file) as f:
+        doc_freqs = [(line.split()[0], int(line.split()[1])) for line in f]
+    common_terms = sorted(doc_freqs, key=lambda entry: entry[1])[-300:]
+
+    pairs = []
+    while len(pairs) < 200:
+        common_term, common_doc_freq = rng.choice(common_terms)
+        target = common_doc_freq // ratio
+        candidates = [term for term, doc_freq in doc_freqs if abs(doc_freq - target) <= max(2, target // 10)]
+        if len(candidates) > 0:
+            pairs.append((rng.choice(candidates), common_term))
+    return pairs
+
+
+def benchmark_and(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    rng = random.Random(3245)
+
+    for ratio in [1, 2, 4, 16, 64, 256]:
+        pairs = [(inverted_index_class.get_posting_list_for_term(rare_term),
+                  inverted_index_class.get_posting_list_for_term(common_term))
+                 for rare_term, common_term in sample_term_pairs(dict_file, ratio, rng)]
+
+        start_time = time.perf_counter()
+        skipped = [intersect_with_skips(small, large) for small, large in pairs]
+        skip_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        intersected = [intersect(small, large) for small, large in pairs]
+        intersect_time = time.perf_counter() - start_time
+
+        assert skipped == intersected
+        print("Size ratio {}: skip pointers {:.4f}s, intersect {:.4f}s ({:.1f}x)".format(
+            ratio, skip_time, intersect_time, skip_time / intersect_time))
+
+    inverted_index_class.close()
+
+
+def benchmark_skips(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    rng = random.Random(3245)
+
+    for ratio in [1, 4, 16, 64, 256]:
+        pairs = sample_term_pairs(dict_file, ratio, rng)
+
+        # Decoding both posting lists in full, as before the skip table was stored
+        start_time = time.perf_counter()
+        decoded = [intersect(inverted_index_class.get_posting_list_for_term(rare_term),
+                             inverted_index_class.get_posting_list_for_term(common_term))
+                   for rare_term, common_term in pairs]
+        decode_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        skipped = [intersect_all([inverted_index_class.get_cursor_for_term(rare_term),
+                                  inverted_index_class.get_cursor_for_term(common_term)])
+                   for rare_term, common_term in pairs]
+        skip_time = time.perf_counter() - start_time
+
+        assert decoded == [as_list(docs) for docs in skipped]
+        print("Size ratio {}: decode {:.4f}s, skip table {:.4f}s ({:.1f}x)".format(
+            ratio, decode_time, skip_time, decode_time / skip_time))
+
+    inverted_index_class.close()
+
+
+def as_list(docs):
+    """
+        Doc ids of a result, which is a Bitmap when the posting lists it was computed from are stored as bitmaps
+    """
+    if isinstance(docs, list):
+        return docs
+    return docs.to_list()
+
+
+def benchmark_bitmap(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    # Terms stored as bitmaps
+    terms = [term for term in read_terms_by_doc_freq(dict_file, 1000)
+             if not isinstance(inverted_index_class.get_postings_for_term(term), list)]
+    print("{} terms stored as bitmaps".format(len(terms)))
+    rng = random.Random(3245)
+    pairs = [rng.sample(terms, 2) for _ in range(200)]
+
+    for name, operation in [("AND", intersect), ("OR", lambda l1, l2: merge_or_all([l1, l2])),
+                            ("AND NOT", difference)]:
+        # Operating on the decoded lists, as before posting lists were stored as bitmaps
+        start_time = time.perf_counter()
+        listed = [operation(inverted_index_class.get_posting_list_for_term(term_1),
+                            inverted_index_class.get_posting_list_for_term(term_2)) for term_1, term_2 in pairs]
+        list_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        bitmapped = [operation(inverted_index_class.get_postings_for_term(term_1),
+                               inverted_index_class.get_postings_for_term(term_2)) for term_1, term_2 in pairs]
+        bitmap_time = time.perf_counter() - start_time
+
+        assert listed == [as_list(docs) for docs in bitmapped]
+        print("{}: lists {:.4f}s, bitmaps {:.4f}s ({:.1f}x)".format(
+            name, list_time, bitmap_time, list_time / bitmap_time))
+
+    inverted_index_class.close()
+
+
+def benchmark_numpy(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    inverted_index_numpy = InvertedIndex(out_dict=dict_file, out_postings=postings_file, engine="numpy")
+    rng = random.Random(3245)
+
+    for num_terms in [200, 2000, 20000]:
+        terms = read_terms_by_doc_freq(dict_file, num_terms)
+        pairs = [rng.sample(terms, 2) for _ in range(500)]
+
+        for name, operation in [("AND", intersect), ("OR", lambda l1, l2: merge_or_all([l1, l2])),
+                                ("AND NOT", difference)]:
+            start_time = time.perf_counter()
+            listed = [operation(inverted_index_class.get_postings_for_term(term_1),
+                                inverted_index_class.get_postings_for_term(term_2)) for term_1, term_2 in pairs]
+            list_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            vectorized = [operation(inverted_index_numpy.get_postings_for_term(term_1),
+                                    inverted_index_numpy.get_postings_for_term(term_2)) for term_1, term_2 in pairs]
+            numpy_time = time.perf_counter() - start_time
+
+            assert [as_list(docs) for docs in listed] == [docs.tolist() for docs in vectorized]
+            print("{} most frequent terms, {}: python {:.4f}s, numpy {:.4f}s ({:.1f}x)".format(
+                num_terms, name, list_time, numpy_time, list_time / numpy_time))
+
+    inverted_index_class.close()
+    inverted_index_numpy.close()
+
+
+def benchmark_stream(dict_file, postings_file):
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    rng = random.Random(3245)
+    terms = read_terms_by_doc_freq(dict_file, 200)
+    queries = {
+        "OR of 8 frequent terms": ["(" + " OR ".join(rng.sample(terms, 8)) + ")" for _ in range(50)],
+        "AND of 3 frequent terms": [" AND ".join(rng.sample(terms, 3)) for _ in range(50)],
+        "AND NOT": ["({}) AND NOT ({})".format(" OR ".join(rng.sample(terms, 4)), " OR ".join(rng.sample(terms, 4)))
+                    for _ in range(50)],
+    }
+
+    for name, query_strings in queries.items():
+        results = {}
+        for mode, evaluate in [("lists", lambda query: query.evaluate(inverted_index_class)),
+                               ("stream", lambda query: list(query.evaluate_iter(inverted_index_class)))]:
+            start_time = time.perf_counter()
+            results[mode] = [evaluate(QueryParser.parse(query_string)) for query_string in query_strings]
+            mode_time = time.perf_counter() - start_time
+
+            # Largest memory used by a single query, with the streamed doc ids counted rather than collected,
+            # as search.py -S writes them out straight away
+            peak = 0
+            tracemalloc.start()
+            for query_string in query_strings:
+                query = QueryParser.parse(query_string)
+                tracemalloc.reset_peak()
+                start_memory = tracemalloc.get_traced_memory()[0]
+                if mode == "lists":
+                    docs = query.evaluate(inverted_index_class)
+                else:
+                    for doc_id in query.evaluate_iter(inverted_index_class):
+                        pass
+                peak = max(peak, tracemalloc.get_traced_memory()[1] - start_memory)
+                docs = None
+            tracemalloc.stop()
+            print("{}, {}: {:.4f}s, peak memory per query {}KB".format(name, mode, mode_time, peak // 1024))
+        assert results["lists"] == results["stream"]
+
+    inverted_index_class.close()
+
+
+INDEX_BENCHMARKS = {
+    "inversion": benchmark_inversion,
+    "tokenizer": benchmark_tokenizer,
+    "merge": benchmark_merge,
+    "merge_queue": benchmark_merge_queue,
+}
+
+SEARCH_BENCHMARKS = {
+    "or": benchmark_or,
+    "and": benchmark_and,
+    "skips": benchmark_skips,
+    "bitmap": benchmark_bitmap,
+    "numpy": benchmark_numpy,
+    "stream": benchmark_stream,
+}
+
+if __name__ == '__main__':
+    benchmark = input_directory = dictionary_file = postings_file = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'b:i:d:p:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-b':
+            benchmark = a
+        elif o == '-i':
+            input_directory = a
+        elif o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        else:
+            assert False, "unhandled option"
+
+    if benchmark in INDEX_BENCHMARKS and input_directory != None:
+        INDEX_BENCHMARKS[benchmark](input_directory)
+    elif benchmark in SEARCH_BENCHMARKS and dictionary_file != None and postings_file != None:
+        SEARCH_BENCHMARKS[benchmark](dictionary_file, postings_file)
+    else:
+        usage()
+        sys.exit(2)
@@ -0,0 +1,91 @@
+"""
+    In-memory bitmap of doc ids, used for the posting lists stored as bitmaps (see postings.py) and for the
+    results computed from them in query.py.
+    Bit d of a python int is set when doc id d is in the bitmap, so AND, OR and AND NOT of two bitmaps are single
+    int operations, which python runs over whole machine words of the int at a time.
+    Converting from and to lists of doc ids goes through a bytes object with one 0/1 flag per doc id, so that the
+    work per doc id happens within int(), str.translate(), filter() and itertools.compress() rather than in python code.
+"""
+from bisect import bisect_left
+from itertools import compress, filterfalse
+
+# Binary digits of an int to 0/1 flags and back
+_TO_FLAGS = bytes.maketrans(b"01", b"\x00\x01")
+_FROM_FLAGS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+class Bitmap:
+    def __init__(self, bits=0):
+        self.bits = bits
+        # Cached number of doc ids, and 0/1 flag of every doc id up to the largest one
+        self.size = None
+        self.flags = None
+
+    @classmethod
+    def from_list(cls, doc_ids):
+        """
+            Builds the bitmap of a sorted list of integer doc ids
+        """
+        if len(doc_ids) == 0:
+            return cls()
+        flags = bytearray(doc_ids[-1] + 1)
+        for doc_id in doc_ids:
+            flags[doc_id] = 1
+        bitmap = cls(int(flags[::-1].translate(_FROM_FLAGS), 2))
+        bitmap.size = len(doc_ids)
+        bitmap.flags = flags
+        return bitmap
+
+    def get_flags(self):
+        """
+            Returns a bytes-like object of length largest doc id + 1, where flags[d] is 1 if doc id d is in the bitmap
+        """
+        if self.flags is None:
+            if self.bits == 0:
+                self.flags = b""
+            else:
+                self.flags = format(self.bits, "b")[::-1].encode("ascii").translate(_TO_FLAGS)
+        return self.flags
+
+    def to_list(self):
+        return list(compress(range(len(self.get_flags())), self.get_flags()))
+
+    def select(self, doc_ids):
+        """
+            Returns the doc ids of the sorted list doc_ids that are in the bitmap
+        """
+        flags = self.get_flags()
+        if len(doc_ids) > 0 and doc_ids[-1] >= len(flags):
+            doc_ids = doc_ids[:bisect_left(doc_ids, len(flags))]
+        return list(filter(flags.__getitem__, doc_ids))
+
+    def reject(self, doc_ids):
+        """
+            Returns the doc ids of the sorted list doc_ids that are not in the bitmap
+        """
+        flags = self.get_flags()
+        if len(doc_ids) > 0 and doc_ids[-1] >= len(flags):
+            end = bisect_left(doc_ids, len(flags))
+            return list(filterfalse(flags.__getitem__, doc_ids[:end])) + doc_ids[end:]
+        return list(filterfalse(flags.__getitem__, doc_ids))
+
+    def __len__(self):
+        if self.size is None:
+            self.size = bin(self.bits).count("1")
+        return self.size
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits)
+
+    def __repr__(self):
+        return "Bitmap({})".format(self.to_list())
+
@@ -0,0 +1,205 @@
+import mmap
+import os
+from array import array
+
+from postings import vb_encode_number, vb_decode_number
+
+
+class CompactDictionary:
+    """
+        Compact in-memory form of dictionary.txt, used by search.py.
+        - Terms are kept sorted in a single bytes blob using blocked front coding (IIR Chapter 5.2.2).
+          Every BLOCK_SIZE terms start a new block. The first term of a block is stored in full as
+          <length><term>, the rest as <length of prefix shared with previous term><length of suffix><suffix>,
+          all lengths being variable byte encoded.
+        - block_offsets[b] is the position of block b in the blob.
+        - doc_freqs[i] and offsets[i] are the size of the posting list and its byte offset in posting.txt
+          for the i-th term in sorted order.
+        Terms are looked up with a binary search over the first term of every block, followed by a linear scan
+        of at most BLOCK_SIZE terms within the block.
+        When loaded from a snapshot (see load_snapshot), the arrays are memoryviews into the mapped snapshot file.
+    """
+
+    BLOCK_SIZE = 8
+
+    def __init__(self):
+        self.blob = b""
+        self.block_offsets = array('q')
+        self.doc_freqs = array('q')
+        self.offsets = array('q')
+        self.snapshot_map = None
+
+    @classmethod
+    def build(cls, entries):
+        """
+            Builds the dictionary from an iterable of (term, size of posting list, offset) sorted by term
+        """
+        dictionary = cls()
+        blob = bytearray()
+        prev = b""
+        for i, (term, doc_freq, offset) in enumerate(entries):
+            term = term.encode("utf-8")
+            if i % cls.BLOCK_SIZE == 0:
+                dictionary.block_offsets.append(len(blob))
+                vb_encode_number(len(term), blob)
+                blob += term
+            else:
+                prefix_len = 0
+                max_prefix_len = min(len(prev), len(term))
+                while prefix_len < max_prefix_len and prev[prefix_len] == term[prefix_len]:
+                    prefix_len += 1
+                vb_encode_number(prefix_len, blob)
+                vb_encode_number(len(term) - prefix_len, blob)
+                blob += term[prefix_len:]
+            dictionary.doc_freqs.append(int(doc_freq))
+            dictionary.offsets.append(int(offset))
+            prev = term
+
+        dictionary.blob = bytes(blob)
+        return dictionary
+
+    def _block_first_term(self, block):
+        length, pos = vb_decode_number(self.blob, self.block_offsets[block])
+        return self.blob[pos:pos + length]
+
+    def index_of(self, term):
+        """
+            Returns the position of term in sorted order, or -1 if term is not in the dictionary
+        """
+        if len(self.block_offsets) == 0:
+            return -1
+        term = term.encode("utf-8")
+
+        # Binary search for the last block whose first term is <= term
+        lo = 0
+        hi = len(self.block_offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._block_first_term(mid) <= term:
+                lo = mid + 1
+            else:
+                hi = mid
+        block = lo - 1
+        if block < 0:
+            return -1
+
+        # Scan the block
+        length, pos = vb_decode_number(self.blob, self.block_offsets[block])
+        curr = self.blob[pos:pos + length]
+        pos += length
+        index = block * self.BLOCK_SIZE
+        end = min(index + self.BLOCK_SIZE, len(self.doc_freqs))
+        while True:
+            if curr == term:
+                return index
+            if curr > term:
+                return -1
+            index += 1
+            if index == end:
+                return -1
+            prefix_len, pos = vb_decode_number(self.blob, pos)
+            suffix_len, pos = vb_decode_number(self.blob, pos)
+            curr = curr[:prefix_len] + self.blob[pos:pos + suffix_len]
+            pos += suffix_len
+
+    def get(self, term, default=None):
+        index = self.index_of(term)
+        if index == -1:
+            return default
+        return self.doc_freqs[index], self.offsets[index]
+
+    def __getitem__(self, term):
+        """
+            Returns a tuple of (size of posting list, byte offset in posting.txt) as ints
+        """
+        index = self.index_of(term)
+        if index == -1:
+            raise KeyError(term)
+        return self.doc_freqs[index], self.offsets[index]
+
+    def __contains__(self, term):
+        return self.index_of(term) != -1
+
+    def __len__(self):
+        return len(self.doc_freqs)
+
+    def close(self):
+        """
+            Releases the memory mapped snapshot backing this dictionary, if any
+        """
+        if self.snapshot_map is None:
+            return
+        self.block_offsets.release()
+        self.doc_freqs.release()
+        self.offsets.release()
+        self.snapshot_map.close()
+        self.snapshot_map = None
+
+
+"""
+    Binary snapshot of the dictionary and the list of all doc ids, written by index.py next to dictionary.txt.
+    search.py memory maps it, so loading takes time independent of the vocabulary size instead of parsing
+    dictionary.txt line by line. Layout, all integers being native 8 byte ints:
+        SNAPSHOT_MAGIC, byte order marker (1), number of terms, number of blocks, number of doc ids, length of blob
+        block_offsets, doc_freqs, offsets, all doc ids, blob
+"""
+SNAPSHOT_MAGIC = b"CS3245D1"
+SNAPSHOT_HEADER_FIELDS = 5
+
+
+def get_snapshot_path(dict_file):
+    return os.path.splitext(dict_file)[0] + ".bin"
+
+
+def write_snapshot(snapshot_file, dictionary, all_files):
+    header = array('q', [1, len(dictionary.doc_freqs), len(dictionary.block_offsets), len(all_files),
+                         len(dictionary.blob)])
+    with open(snapshot_file, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(header.tobytes())
+        f.write(array('q', dictionary.block_offsets).tobytes())
+        f.write(array('q', dictionary.doc_freqs).tobytes())
+        f.write(array('q', dictionary.offsets).tobytes())
+        f.write(array('q', all_files).tobytes())
+        f.write(bytes(dictionary.blob))
+
+
+def load_snapshot(snapshot_file):
+    """
+        Memory maps the snapshot. The integer arrays of the returned dictionary are views into the mapping.
+        Returns a tuple of (CompactDictionary, list of all doc ids), or None if the snapshot can not be used
+    """
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    pos = len(SNAPSHOT_MAGIC)
+    header_end = pos + SNAPSHOT_HEADER_FIELDS * 8
+    if len(snapshot_map) < header_end or snapshot_map[:pos] != SNAPSHOT_MAGIC:
+        snapshot_map.close()
+        return None
+    header = array('q', snapshot_map[pos:header_end])
+    byte_order, num_terms, num_blocks, num_docs, blob_len = header
+    if byte_order != 1:
+        # Snapshot was written on a machine with a different byte order
+        snapshot_map.close()
+        return None
+
+    dictionary = CompactDictionary()
+    with memoryview(snapshot_map) as view:
+        pos = header_end
+        dictionary.block_offsets = view[pos:pos + num_blocks * 8].cast('q')
+        pos += num_blocks * 8
+        dictionary.doc_freqs = view[pos:pos + num_terms * 8].cast('q')
+        pos += num_terms * 8
+        dictionary.offsets = view[pos:pos + num_terms * 8].cast('q')
+        pos += num_terms * 8
+        with view[pos:pos + num_docs * 8].cast('q') as all_files_view:
+            all_files = all_files_view.tolist()
+        pos += num_docs * 8
+        dictionary.blob = snapshot_map[pos:pos + blob_len]
+
+    dictionary.snapshot_map = snapshot_map
+    return dictionary, all_files
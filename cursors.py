@@ -0,0 +1,210 @@
+"""
+    Cursors of the pull model of query evaluation (see Query.stream in query.py).
+    A cursor produces the doc ids of a query in increasing order, one at a time, with the interface of
+    postings.PostingsCursor:
+        next()          Moves to the next doc id and returns it, or None at the end.
+        advance(target) Moves to the first doc id >= target, from the current one onwards, and returns it,
+                        or None if there is no such doc id.
+    The cursors of AND, OR and NOT pull doc ids from the cursors of their operands, so a query is evaluated
+    without building any intermediate list, and a cursor only holds a few doc ids per operand.
+"""
+from bisect import bisect_left
+from heapq import heapify, heapreplace, heappop
+
+from bitmap import Bitmap
+from postings import PostingsCursor
+from vectorized import is_array
+
+
+class ListCursor:
+    """
+        Cursor over a sorted list of doc ids, such as the list of all doc ids or a decoded posting list
+    """
+
+    def __init__(self, docs):
+        self.docs = docs.tolist() if is_array(docs) else docs
+        self.index = -1
+
+    def next(self):
+        self.index += 1
+        if self.index >= len(self.docs):
+            self.index = len(self.docs)
+            return None
+        return self.docs[self.index]
+
+    def advance(self, target):
+        if self.index >= len(self.docs):
+            return None
+        if self.index >= 0 and self.docs[self.index] >= target:
+            return self.docs[self.index]
+        self.index = bisect_left(self.docs, target, max(self.index, 0))
+        if self.index >= len(self.docs):
+            return None
+        return self.docs[self.index]
+
+
+class BitmapCursor:
+    """
+        Cursor over a Bitmap, finding the next set flag (see Bitmap.get_flags) with bytes.find
+    """
+
+    def __init__(self, bitmap):
+        self.flags = bitmap.get_flags()
+        self.doc = -1
+
+    def next(self):
+        if self.doc is None:
+            return None
+        return self._find(self.doc + 1)
+
+    def advance(self, target):
+        if self.doc is None:
+            return None
+        if self.doc >= target:
+            return self.doc
+        return self._find(target)
+
+    def _find(self, start):
+        doc = self.flags.find(1, start)
+        self.doc = doc if doc >= 0 else None
+        return self.doc
+
+
+class AndCursor:
+    """
+        Intersection of cursors, minus the doc ids of negated cursors.
+        Each doc id of the first cursor is skipped ahead to in the others. Whenever one of them is past it, the first
+        cursor is skipped ahead to that doc id instead, so the cursors leapfrog each other. Doc ids found in every
+        cursor are then looked up in the negated cursors.
+    """
+
+    def __init__(self, cursors, negated_cursors):
+        self.cursors = cursors
+        self.negated_cursors = negated_cursors
+        self.doc = -1
+
+    def next(self):
+        if self.doc is None:
+            return None
+        return self._align(self.cursors[0].next())
+
+    def advance(self, target):
+        if self.doc is None:
+            return None
+        if self.doc >= target:
+            return self.doc
+        return self._align(self.cursors[0].advance(target))
+
+    def _align(self, doc):
+        """
+            Moves to the first doc id >= doc of the first cursor that satisfies the intersection
+        """
+        first = self.cursors[0]
+        while doc is not None:
+            for cursor in self.cursors[1:]:
+                other = cursor.advance(doc)
+                if other != doc:
+                    doc = first.advance(other) if other is not None else None
+                    break
+            else:
+                if not any([cursor.advance(doc) == doc for cursor in self.negated_cursors]):
+                    break
+                doc = first.next()
+        self.doc = doc
+        return doc
+
+
+class OrCursor:
+    """
+        Union of cursors, with a heap of the current doc id of every cursor that is not at its end
+    """
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+        # (doc id, index of the cursor), started on the first call to next() or advance()
+        self.heap = None
+        self.doc = -1
+
+    def _start(self):
+        self.heap = []
+        for i, cursor in enumerate(self.cursors):
+            doc = cursor.next()
+            if doc is not None:
+                self.heap.append((doc, i))
+        heapify(self.heap)
+
+    def next(self):
+        if self.doc is None:
+            return None
+        if self.heap is None:
+            self._start()
+        else:
+            heap = self.heap
+            while len(heap) > 0 and heap[0][0] == self.doc:
+                doc = self.cursors[heap[0][1]].next()
+                if doc is None:
+                    heappop(heap)
+                else:
+                    heapreplace(heap, (doc, heap[0][1]))
+        return self._set_doc()
+
+    def advance(self, target):
+        if self.doc is None:
+            return None
+        if self.heap is None:
+            self._start()
+        elif self.doc >= target:
+            return self.doc
+        heap = self.heap
+        while len(heap) > 0 and heap[0][0] < target:
+            doc = self.cursors[heap[0][1]].advance(target)
+            if doc is None:
+                heappop(heap)
+            else:
+                heapreplace(heap, (doc, heap[0][1]))
+        return self._set_doc()
+
+    def _set_doc(self):
+        self.doc = self.heap[0][0] if len(self.heap) > 0 else None
+        return self.doc
+
+
+class NotCursor:
+    """
+        Complement of a cursor: the doc ids of the cursor over all doc ids which are not in the cursor
+    """
+
+    def __init__(self, cursor, all_docs):
+        self.cursor = cursor
+        self.all_docs = all_docs
+        self.doc = -1
+
+    def next(self):
+        if self.doc is None:
+            return None
+        return self._skip(self.all_docs.next())
+
+    def advance(self, target):
+        if self.doc is None:
+            return None
+        if self.doc >= target:
+            return self.doc
+        return self._skip(self.all_docs.advance(target))
+
+    def _skip(self, doc):
+        while doc is not None and self.cursor.advance(doc) == doc:
+            doc = self.all_docs.next()
+        self.doc = doc
+        return doc
+
+
+def as_cursor(docs):
+    """
+        Returns a cursor over a PostingsCursor, a Bitmap, an array or a list of doc ids, as returned by
+        InvertedIndex.get_cursor_for_term
+    """
+    if isinstance(docs, Bitmap):
+        return BitmapCursor(docs)
+    if isinstance(docs, PostingsCursor):
+        return docs
+    return ListCursor(docs)
@@ -4,10 +4,12 @@ import getopt
 import time
 
 from inverted_index import InvertedIndex
+from tokenizer import TOKENIZERS
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file [-j num-processes]"
+          " [-t nltk|regex] [-f merge-fan-in] [-m block-memory-bytes]")
 
 
 """
@@ -15,7 +17,7 @@ def usage():
     then output the dictionary file and postings file
 """
 
-def build_index(in_dir, out_dict, out_postings):
+def build_index(in_dir, out_dict, out_postings, num_workers=1, tokenizer="nltk", fan_in=None, block_bytes=None):
 
     print('Indexing...')
 
@@ -23,33 +25,50 @@ def build_index(in_dir, out_dict, out_postings):
     # Pls implement your code in below
 
     start_time = time.perf_counter()
-    inverted_index_class = InvertedIndex(in_dir, out_dict, out_postings)
-    inverted_index_class.construct_index()
+    inverted_index_class = InvertedIndex(in_dir, out_dict, out_postings, tokenizer)
+    inverted_index_class.construct_index(num_workers, fan_in, block_bytes)
     end_time = time.perf_counter()
     print("Indexed in {:.2f}s".format(end_time-start_time))
 
 
-
-input_directory = output_file_dictionary = output_file_postings = None
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-i': # input directory
-        input_directory = a
-    elif o == '-d': # dictionary file
-        output_file_dictionary = a
-    elif o == '-p': # postings file
-        output_file_postings = a
-    else:
-        assert False, "unhandled option"
-
-if input_directory == None or output_file_postings == None or output_file_dictionary == None:
-    usage()
-    sys.exit(2)
-
-build_index(input_directory, output_file_dictionary, output_file_postings)
+# Blocks are built by a pool of processes when -j is given, which re-import this module on platforms
+# that spawn processes, hence the guard
+if __name__ == '__main__':
+    input_directory = output_file_dictionary = output_file_postings = None
+    num_workers = 1
+    tokenizer = "nltk"
+    fan_in = None
+    block_bytes = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:j:t:f:m:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i': # input directory
+            input_directory = a
+        elif o == '-d': # dictionary file
+            output_file_dictionary = a
+        elif o == '-p': # postings file
+            output_file_postings = a
+        elif o == '-j': # number of processes
+            num_workers = int(a)
+        elif o == '-t': # tokenizer
+            tokenizer = a
+        elif o == '-f': # maximum number of blocks merged at once
+            fan_in = int(a)
+        elif o == '-m': # memory budget of the postings of a block in bytes
+            block_bytes = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if input_directory == None or output_file_postings == None or output_file_dictionary == None or num_workers < 1 \
+            or tokenizer not in TOKENIZERS or (fan_in != None and fan_in < 2) \
+            or (block_bytes != None and block_bytes < 1):
+        usage()
+        sys.exit(2)
+
+    build_index(input_directory, output_file_dictionary, output_file_postings, num_workers, tokenizer, fan_in,
+                block_bytes)
@@ -1,18 +1,30 @@
+import mmap
 import os
-from sys import platform
 import shutil
-import string
+import sys
 import time
 
-from queue import PriorityQueue
-from math import sqrt
-from math import ceil, floor
-from nltk.tokenize import word_tokenize
-from nltk.tokenize import sent_tokenize
+from bisect import bisect_left
+from heapq import merge
+from math import ceil
+from multiprocessing import Pool
 from nltk.stem.porter import PorterStemmer
 
 from collections import defaultdict
 
+from bitmap import Bitmap
+from compact_dictionary import CompactDictionary, get_snapshot_path, write_snapshot, load_snapshot
+from vectorized import as_array, bitmap_to_array, decode_postings_array
+from postings import encode_postings, decode_header, decode_body, decode_containers, PostingsCursor, POSTINGS_BITMAP
+from lru_cache import LRUCache
+from tokenizer import TOKENIZERS
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak RSS is not reported with blocks
+    resource = None
+
 
 class InvertedIndex:
     """
@@ -20,20 +32,60 @@ class InvertedIndex:
         - We will write out a subset of the posting list to block files under /block folder using SPIMI-Invert method.
         - Once all those block files have been filled, we will then process all these block files together
         - and append to posting.txt using the BISC k-way merge
+        - posting.txt is a binary file of gap encoded posting lists, see postings.py for the format
         search.py can use inverted_index.py to retrieve terms' posting lists, skip pointers.
         - Loading dictionary from memory will be done at class constructor.
+        - posting.txt is memory mapped once at class constructor and posting lists are decoded from the mapping.
         - Only self.dictionary will have contents.
     """
 
+    # Number of dictionary lines and posting lists written to dictionary.txt and posting.txt at once
     MAX_LINES_TO_HOLD_IN_MEM = 100000
-
-    def __init__(self, in_dir="", out_dict="dictionary.txt", out_postings="postings.txt"):
+    # Default memory budget of the postings of a SPIMI block in bytes. Once the estimated size of the postings in
+    # memory reaches it, they are written to a block
+    BLOCK_BYTES = 64 * 1024 * 1024
+    # Estimated bytes taken in memory by a new term of a block (its list, and its entries in the postings dict and
+    # the dictionary set; the term string itself is shared with the stemming cache), and by a new posting
+    # (a pointer to the doc id, shared by all the terms of the doc, plus the over-allocation of the list)
+    TERM_BYTES = 152
+    POSTING_BYTES = 9
+    # Maximum number of blocks merged at once, and size of the read buffer of every block file
+    MERGE_FAN_IN = 64
+    BLOCK_BUFFER_BYTES = 1024 * 1024
+
+    def __init__(self, in_dir="", out_dict="dictionary.txt", out_postings="postings.txt", tokenizer="nltk",
+                 engine="python", cache_bytes=0, result_cache_bytes=0):
         print("Initialise Inverted Indexes...")
 
         self.in_dir = in_dir
+        # Name of the tokenizer in tokenizer.TOKENIZERS used to read documents
+        self.tokenizer = tokenizer
+        # Engine evaluating queries, "python" or "numpy". With "numpy", posting lists are returned as int32 arrays
+        # (see vectorized.py)
+        self.engine = engine
+        # Decoded posting lists of the most recently used terms, up to cache_bytes in total. 0 disables the cache
+        self.postings_cache = LRUCache(cache_bytes, get_postings_size)
+        # Results of the most recently evaluated AND and OR queries by their canonical form (see Query.canonicalize),
+        # as tuples of (documents, is_negated), up to result_cache_bytes in total. 0 disables the cache
+        self.result_cache = LRUCache(result_cache_bytes, lambda result: get_postings_size(result[0]))
         self.out_dict = out_dict
         self.out_postings = out_postings
+        self.snapshot_file = get_snapshot_path(out_dict)
         self.all_files = []
+        # self.dictionary is a CompactDictionary which maps the term name
+        # to a tuple of (size of posting list, byte offset of the posting list in posting.txt)
+        self.dictionary = CompactDictionary()
+        # Memory mapped posting.txt and a memoryview over it, so that posting lists can be sliced without copying
+        self.postings_map = None
+        self.postings_view = None
+
+        # Load Dictionary Terms into memory when search.py initialises inverted_index
+        # The binary snapshot written by index.py is preferred over parsing dictionary.txt and document_id_list.txt
+        if in_dir == "" and self.load_dictionary_from_snapshot():
+            self.map_postings()
+            self.prepare_engine()
+            return
+
         try:
             with open("document_id_list.txt") as f:
                 for line in f.readlines():
@@ -41,18 +93,10 @@ class InvertedIndex:
         except FileNotFoundError:
             print("Doc id list not created")
 
-        # self.dictionary set is a dictionary where the key is the term name
-        # and the value is a tuple of (size of posting list, offset from top line of posting.txt)
-        self.dictionary = {}
-        # Load Dictionary Terms into memory when search.py initialises inverted_index
         if in_dir == "":
             self.load_dictionary_from_mem()
-
-        if platform == "win32":
-            print("Running on Windows")
-            self.new_line_offset = 1
-        else:
-            self.new_line_offset = 0
+            self.map_postings()
+            self.prepare_engine()
 
     """
         ////////////////////////////////////////
@@ -60,20 +104,19 @@ class InvertedIndex:
         ////////////////////////////////////////
     """
 
-    def construct_index(self):
+    def construct_index(self, num_workers=1, fan_in=None, block_bytes=None):
         """
                    Method to read the data file and fill up self.postings and self.dictionary.
                    Current implementation only removes punctuations, case folding and do word stemming.
                    It does not remove stop words.
+                   Params:
+                        - num_workers: Number of processes building blocks. The docs are split into num_workers
+                          contiguous ranges of doc ids, and each process builds the blocks of one range.
+                        - fan_in: Maximum number of blocks merged at once, see merge_blocks
+                        - block_bytes: Memory budget of the postings of a block, see build_blocks
         """
         print("Constructing Indexes...")
 
-        stemmer = PorterStemmer()
-        translator = str.maketrans('', '', string.punctuation)
-
-        block_index = 0
-        curr_lines_in_mem = 0  # Number of term-posting list pair
-
         self.reset_files()
 
         # Get all the file names in reuters
@@ -82,61 +125,135 @@ class InvertedIndex:
             all_files.append(int(doc_id))
         all_files = sorted(all_files)
 
+        with open("document_id_list.txt", 'w') as f:
+            f.write(",".join([str(i) for i in all_files]))
+        self.all_files = all_files
+
+        if num_workers > 1:
+            total_num_blocks = self.build_blocks_in_parallel(all_files, num_workers, block_bytes)
+        else:
+            total_num_blocks = self.build_blocks(all_files, block_bytes=block_bytes)
+
+        self.merge_blocks(total_num_blocks, fan_in)
+        self.save_snapshot()
+
+    def build_blocks_in_parallel(self, all_files, num_workers, block_bytes=None):
+        """
+                   Method to build the blocks of all_files with a pool of num_workers processes.
+                   Blocks are renumbered in the order of their doc id ranges once all processes are done, so that
+                   merge_blocks sees them in the same order as if they had been built by a single process, and the
+                   resulting dictionary.txt and postings.txt are identical.
+                   Returns:
+                        Total number of blocks written
+        """
+        range_size = ceil(len(all_files) / num_workers)
+        doc_ranges = [all_files[i:i + range_size] for i in range(0, len(all_files), range_size)]
+        args = [(self.in_dir, self.out_dict, self.out_postings, self.tokenizer, doc_ids, "{}-".format(worker),
+                 block_bytes) for worker, doc_ids in enumerate(doc_ranges)]
+
+        with Pool(num_workers) as pool:
+            num_blocks_per_range = pool.map(build_blocks_for_range, args)
+
+        block_index = 0
+        for worker, num_blocks in enumerate(num_blocks_per_range):
+            for i in range(num_blocks):
+                os.rename("blocks/{}-{}".format(worker, i), "blocks/" + str(block_index))
+                block_index += 1
+        return block_index
+
+    def build_blocks(self, doc_ids, block_prefix="", block_bytes=None):
+        """
+                   Method to build the SPIMI blocks of doc_ids, written to blocks/<block_prefix><block_index>
+                   A block is written once the estimated size of the postings in memory reaches block_bytes,
+                   counting TERM_BYTES per distinct term and POSTING_BYTES per posting of the block, so that the
+                   size of blocks follows their memory use rather than the number of tokens read.
+                   The peak RSS of the process so far is reported with every block.
+                   Params:
+                        - doc_ids: Sorted list of doc ids to read
+                        - block_prefix: Prefix of the block file names
+                        - block_bytes: Memory budget of the postings of a block, BLOCK_BYTES by default
+                   Returns:
+                        Number of blocks written
+        """
+        if block_bytes == None:
+            block_bytes = self.BLOCK_BYTES
+        stemmer = PorterStemmer()
+
+        block_index = 0
+        curr_bytes_in_mem = 0  # Estimated size of postings and dictionary
+
         postings = defaultdict(list)  # key: Term, Value: List of doc_id
         dictionary = set()  # Terms
         stem_dict = {}
 
-        with open("document_id_list.txt", 'w') as f:
-            f.write(",".join([str(i) for i in all_files]))
-
         start_time = time.perf_counter()
         # Read in ascending order of their file names
-        for doc_id in all_files:
-            with open(os.path.join(self.in_dir, str(doc_id))) as file:
-                for line in file:
-                    # Tokenize by sentences
-                    for s_token in sent_tokenize(line):
-                        # Tokenize by word
-                        for w_token in word_tokenize(s_token):
-
-                            # Remove Punctuation & Case-Folding
-                            w_token = w_token.translate(translator).lower()
-
-                            # Word Stemming
-                            if w_token in stem_dict:
-                                term = stem_dict[w_token]
-                            else:
-                                term = stemmer.stem(w_token)
-                                stem_dict[w_token] = term
-
-                            # Remove numbers
-                            if w_token.isnumeric() or len(term) == 0:
-                                continue
-
-                            curr_lines_in_mem += 1
-                            if term not in dictionary:
-                                dictionary.add(term)
-
-                            if doc_id not in postings[term]:
-                                postings[term].append(doc_id)
-
-                            # Write the previous items to new block
-                            if curr_lines_in_mem == self.MAX_LINES_TO_HOLD_IN_MEM:
-                                self.write_block_to_disk(block_index, postings, dictionary)
-                                print("Create block {} ({:.2f}s)".format(block_index, time.perf_counter() - start_time))
-                                start_time = time.perf_counter()
-                                # Reset
-                                curr_lines_in_mem = 0
-                                postings = defaultdict(list)
-                                dictionary = set()
-                                block_index += 1
+        for doc_id in doc_ids:
+            for term in self.read_terms(doc_id, stemmer, stem_dict):
+                if term not in dictionary:
+                    dictionary.add(term)
+                    curr_bytes_in_mem += self.TERM_BYTES
+
+                # Docs are processed in ascending order, so if doc_id is already in the posting list
+                # it can only be the last item. This keeps inversion linear in the number of tokens.
+                posting_list = postings[term]
+                if len(posting_list) == 0 or posting_list[-1] != doc_id:
+                    posting_list.append(doc_id)
+                    curr_bytes_in_mem += self.POSTING_BYTES
+
+                # Write the previous items to new block
+                if curr_bytes_in_mem >= block_bytes:
+                    self.write_block_to_disk(block_prefix + str(block_index), postings, dictionary)
+                    print_block(block_prefix + str(block_index), time.perf_counter() - start_time, curr_bytes_in_mem)
+                    start_time = time.perf_counter()
+                    # Reset
+                    curr_bytes_in_mem = 0
+                    postings = defaultdict(list)
+                    dictionary = set()
+                    block_index += 1
 
         # Write last block if exists
-        if curr_lines_in_mem > 0:
-            self.write_block_to_disk(block_index, postings, dictionary)
-            self.merge_blocks(block_index + 1)
-        else:
-            self.merge_blocks(block_index)
+        if curr_bytes_in_mem > 0:
+            self.write_block_to_disk(block_prefix + str(block_index), postings, dictionary)
+            print_block(block_prefix + str(block_index), time.perf_counter() - start_time, curr_bytes_in_mem)
+            block_index += 1
+
+        return block_index
+
+    def read_terms(self, doc_id, stemmer, stem_dict):
+        """
+                   Generator of the terms of a document, in the order they appear.
+                   Lines are split into case folded words without punctuations by self.tokenizer.
+                   Params:
+                        - doc_id: Document to read from self.in_dir
+                        - stemmer: PorterStemmer
+                        - stem_dict: Cache of previously stemmed words, shared across documents
+        """
+        tokenize = TOKENIZERS[self.tokenizer]
+        with open(os.path.join(self.in_dir, str(doc_id))) as file:
+            for line in file:
+                for w_token in tokenize(line):
+
+                    # Word Stemming
+                    if w_token in stem_dict:
+                        term = stem_dict[w_token]
+                    else:
+                        term = stemmer.stem(w_token)
+                        stem_dict[w_token] = term
+
+                    # Remove numbers
+                    if w_token.isnumeric() or len(term) == 0:
+                        continue
+
+                    yield term
+
+    def save_snapshot(self):
+        """
+                   Method to write the binary snapshot of dictionary.txt and the list of all doc ids,
+                   which search.py loads without parsing any text. See compact_dictionary.py for the layout.
+        """
+        self.load_dictionary_from_mem()
+        write_snapshot(self.snapshot_file, self.dictionary, self.all_files)
 
     def reset_files(self):
         """
@@ -161,7 +278,7 @@ class InvertedIndex:
                     Method to write the contents of posting lists to a new block file
                     SPIMI-Invert
                     Params:
-                        - block_index: Gives us the file name
+                        - block_index: Gives us the file name, either a number or a string
                         - postings: List of all the posting lists
                         - dictionary: List of all the terms
         """
@@ -177,147 +294,136 @@ class InvertedIndex:
 
         self.write_to_file("blocks/" + str(block_index), result)
 
-    def merge_blocks(self, total_num_blocks):
+    def merge_blocks(self, total_num_blocks, fan_in=None):
         """
                     Method to read all the block files inside /Blocks and append them into Posting.txt
-                    using BSBI Merging -> (total_num_blocks) K-Way Merge
+                    using BSBI Merging -> K-Way Merge of at most fan_in blocks at a time
+                    While there are more than fan_in blocks, every fan_in consecutive blocks are merged into one
+                    intermediate block, so that at most fan_in block files are open at once. The blocks are merged
+                    in ceil(log(total_num_blocks) / log(fan_in)) passes, the last of which writes posting.txt.
                     Params:
                         - total_num_blocks: Total number of block files that we want to merge
+                        - fan_in: Maximum number of blocks merged at once, MERGE_FAN_IN by default
         """
-        print("Merge all " + str(total_num_blocks) + " blocks ...")
+        if fan_in == None:
+            fan_in = self.MERGE_FAN_IN
+        block_files = ["blocks/" + str(block_num) for block_num in range(total_num_blocks)]
+
+        merge_pass = 0
+        while len(block_files) > fan_in:
+            print("Merge pass {}: {} blocks into {} ...".format(merge_pass, len(block_files),
+                                                                ceil(len(block_files) / fan_in)))
+            merged_files = []
+            for i in range(0, len(block_files), fan_in):
+                merged_file = "blocks/pass{}-{}".format(merge_pass, len(merged_files))
+                self.merge_to_block(block_files[i:i + fan_in], merged_file)
+                merged_files.append(merged_file)
+            block_files = merged_files
+            merge_pass += 1
+
+        print("Merge all " + str(len(block_files)) + " blocks ...")
+        self.merge_to_postings(block_files)
+
+    def merge_block_files(self, block_files):
+        """
+                    Generator of the terms of block_files in sorted order, with their merged posting lists.
+                    Every block is read by a generator of (term, block number, doc ids text) tuples, and heapq.merge
+                    keeps the current tuple of every block in a heap. Tuples compare by term, then by block number,
+                    without any python level comparison method. Blocks are read sequentially through buffers of
+                    BLOCK_BUFFER_BYTES, so that reading many blocks does not turn into small reads all over the disk.
+                    The blocks hold consecutive ranges of doc ids, in order, so the posting lists of a term are
+                    concatenated in block order, dropping the doc id repeated when a doc is split across two blocks.
+                    Params:
+                        - block_files: Paths of the block files, in doc id order
+                    Yields:
+                        Tuples of (term, sorted list of integer doc ids)
+        """
+        blocks = [read_block(block_file, block_num, self.BLOCK_BUFFER_BYTES)
+                  for block_num, block_file in enumerate(block_files)]
+        term_to_write = None
+        doc_ids_to_write = []
+        for term, block_num, doc_ids in merge(*blocks):
+            # Encountering new term, End of prev term
+            if term != term_to_write:
+                if term_to_write != None:
+                    yield term_to_write, doc_ids_to_write
+                term_to_write = term
+                doc_ids_to_write = []
 
-        # (1) INITIALISE VARIABLES
-        # blocks_offset[i] stores the offset value for reading from file of block i
-        blocks_offset = [0] * total_num_blocks
+            doc_ids = [int(doc_id) for doc_id in doc_ids.split(" ")]
+            if len(doc_ids_to_write) > 0 and doc_ids[0] == doc_ids_to_write[-1]:
+                doc_ids_to_write += doc_ids[1:]
+            else:
+                doc_ids_to_write += doc_ids
 
-        read_file_pointers = [0] * total_num_blocks
-        for block_num in range(0, total_num_blocks):
-            read_file_pointers[block_num] = open("blocks/" + str(block_num), 'r')
+        if term_to_write != None:
+            yield term_to_write, doc_ids_to_write
 
-        write_posting_file_pointer = open(self.out_postings, 'a')
+    def merge_to_block(self, block_files, merged_file):
+        """
+                    Method to merge block_files into the intermediate block merged_file, in the same format.
+                    The merged blocks are deleted.
+        """
+        with open(merged_file, 'w', buffering=self.BLOCK_BUFFER_BYTES) as fw:
+            for term, doc_ids in self.merge_block_files(block_files):
+                fw.write(term + " " + " ".join([str(i) for i in doc_ids]) + "\n")
+        for block_file in block_files:
+            os.remove(block_file)
+
+    def merge_to_postings(self, block_files):
+        """
+                    Method to merge block_files into Posting.txt and Dictionary.txt.
+                    Encoded posting lists and dictionary lines are written MAX_LINES_TO_HOLD_IN_MEM terms at a time.
+        """
+        write_posting_file_pointer = open(self.out_postings, 'ab')
         write_dict_file_pointer = open(self.out_dict, 'a')
 
-        term_to_write = ''
-        doc_ids_to_write = []
         result_doc_ids_to_write = []
         result_term_to_write = []
-        curr_lines_in_mem = 0
-        posting_file_line_offset = 0
-
-        lines_to_read_per_block = floor(self.MAX_LINES_TO_HOLD_IN_MEM / total_num_blocks)
-        if lines_to_read_per_block == 0:
-            # If the block size limit is smaller than the total num of blocks
-            lines_to_read_per_block = 1
-
-        q = PriorityQueue()
-
-        lines_per_block_mem = [0] * total_num_blocks
-        # (2) INITIAL STEP OF K WAY MERGE: Read in a batch of lines from each block file
-        for block_num in range(0, total_num_blocks):
-            lines = self.read_from_file("blocks/" + str(block_num), blocks_offset[block_num],
-                                        read_file_pointers[block_num], lines_to_read_per_block)
-            for line in lines:
-                blocks_offset[block_num] = blocks_offset[block_num] + len(line) + 1  # 1 for \n
-                q.put(QueueItem(line, block_num))
-                lines_per_block_mem[block_num] += 1
+        posting_file_byte_offset = 0
 
         freq_dict = {}
-        # K_WAY
-        while not q.empty():
-
-            # Process current Item in the queue
-            curr_item = q.get()
-            curr_term = curr_item.get_term()
-            curr_posting_list = curr_item.get_posting_list()
-            curr_block = curr_item.get_block_num()
-
-            lines_per_block_mem[curr_block] -= 1
-
-            # Encountering new term, End of prev term
-            if curr_term != term_to_write and term_to_write != '':
-                docs_with_skip = self.build_list_with_skips(doc_ids_to_write)
-                content = term_to_write + " " + " ".join(docs_with_skip) + "\n"
-                result_doc_ids_to_write.append(content)
-                result_term_to_write.append(term_to_write + " " + str(len(docs_with_skip)) + " " + str(
-                    posting_file_line_offset) + "\n")  # Term Size Offset
-                freq_dict[term_to_write] = len(docs_with_skip)
-
-                posting_file_line_offset += len(content) + self.new_line_offset
-
-                # Complete posting list of prev term, hence increment to indicate new line in posting.txt
-                curr_lines_in_mem += 1
-
-                # Reset for new term
-                doc_ids_to_write = []
+        for term, doc_ids in self.merge_block_files(block_files):
+            content = encode_postings(doc_ids)
+            result_doc_ids_to_write.append(content)
+            result_term_to_write.append(term + " " + str(len(doc_ids)) + " " + str(
+                posting_file_byte_offset) + "\n")  # Term Size Offset
+            freq_dict[term] = len(doc_ids)
+            posting_file_byte_offset += len(content)
 
-            if curr_lines_in_mem == self.MAX_LINES_TO_HOLD_IN_MEM:
-                self.write_to_file(self.out_postings, "".join(result_doc_ids_to_write), True,
+            if len(result_term_to_write) == self.MAX_LINES_TO_HOLD_IN_MEM:
+                self.write_to_file(self.out_postings, b"".join(result_doc_ids_to_write), True,
                                    write_posting_file_pointer)
                 self.write_to_file(self.out_dict, "".join(result_term_to_write), True, write_dict_file_pointer)
-
-                curr_lines_in_mem = 0
                 result_doc_ids_to_write = []
                 result_term_to_write = []
 
-            term_to_write = curr_term
-
-            for doc_id in curr_posting_list:
-                if len(doc_ids_to_write) == 0 or int(doc_id) != int(doc_ids_to_write[-1]):
-                    doc_ids_to_write.append(doc_id)
-
-            # When all the lines from curr_block has been processed, we add in the next batch of
-            # lines from the block
-            if lines_per_block_mem[curr_block] == 0:
-                lines = self.read_from_file("blocks/" + str(curr_block), blocks_offset[curr_block],
-                                            read_file_pointers[curr_block], lines_to_read_per_block)
-                for line in lines:
-                    blocks_offset[curr_block] = blocks_offset[curr_block] + len(line) + 1  # 1 for \n
-                    q.put(QueueItem(line, curr_block))
-                    lines_per_block_mem[curr_block] += 1
-
-        # Add last Term and its' posting lists to result
-        if len(doc_ids_to_write) > 0:
-            docs_with_skip = self.build_list_with_skips(doc_ids_to_write)
-            content = term_to_write + " " + " ".join(docs_with_skip) + "\n"
-            result_doc_ids_to_write.append(content)
-            result_term_to_write.append(term_to_write + " " + str(len(docs_with_skip)) + " " + str(
-                posting_file_line_offset) + "\n")  # Term Size Offset
-            freq_dict[term_to_write] = len(docs_with_skip)
         # Write result in mem to file
-        self.write_to_file(self.out_postings, "".join(result_doc_ids_to_write), True, write_posting_file_pointer)
+        self.write_to_file(self.out_postings, b"".join(result_doc_ids_to_write), True, write_posting_file_pointer)
         self.write_to_file(self.out_dict, "".join(result_term_to_write), True, write_dict_file_pointer)
+        write_posting_file_pointer.close()
+        write_dict_file_pointer.close()
         print("Dictionary size: {}".format(len(freq_dict)))
         print("Posting list size: {}".format(sum(freq_dict.values())))
         self.write_to_file("freq_sorted_dict.txt", ["{} {}\n".format(item[0], item[1]) for item in
                                                     sorted(list(freq_dict.items()), key=lambda i: i[1], reverse=True)])
 
-    def build_list_with_skips(self, posting_list):
-        docs_with_skip = []
-        jump = ceil(sqrt(len(posting_list)))
-
-        for idx, posting in enumerate(posting_list):
-            if idx % jump == 0 and (idx + jump) < len(posting_list):
-                next_val = posting_list[idx + jump]
-                docs_with_skip.append(posting + ";" + next_val)
-            else:
-                docs_with_skip.append(posting)
-
-        return docs_with_skip
-
     def write_to_file(self, out_file, result, append=False, fw=None):
         """
                 Method to Write to out_file.
                 Params:
                     out_file: file path
-                    result: Text to store in out_file
+                    result: Text to store in out_file, or bytes if fw was opened in binary mode
         """
 
-        if not append and fw == None:
-            fw = open(out_file, 'w+')
-        elif append and fw == None:
-            fw = open(out_file, 'a')
+        if fw == None:
+            with open(out_file, 'a' if append else 'w+') as fw:
+                return self.write_to_file(out_file, result, append, fw)
 
-        fw.write(''.join(result))
+        if isinstance(result, bytes):
+            fw.write(result)
+        else:
+            fw.write(''.join(result))
 
     """
         ////////////////////////////////////////
@@ -333,12 +439,76 @@ class InvertedIndex:
         if len(self.dictionary) != 0:
             return
 
+        entries = []
         for term in self.read_from_file(self.out_dict):  # dictionary.txt is already sorted
             term = term.rstrip('\n').strip().split(" ")
             term_name = term[0]
             term_posting_len = term[1]
             offset = term[2]
-            self.dictionary[term_name] = (term_posting_len, offset)
+            entries.append((term_name, term_posting_len, offset))
+        self.dictionary = CompactDictionary.build(entries)
+
+    def load_dictionary_from_snapshot(self):
+        """
+                Method to load self.dictionary and self.all_files from the snapshot written by index.py.
+                The snapshot is ignored if it is missing or older than dictionary.txt
+                Returns:
+                    True if the snapshot was loaded
+        """
+        if not self.is_snapshot_up_to_date():
+            return False
+
+        snapshot = load_snapshot(self.snapshot_file)
+        if snapshot is None:
+            return False
+        self.dictionary, self.all_files = snapshot
+        return True
+
+    def is_snapshot_up_to_date(self):
+        """
+                Returns:
+                    True if the snapshot exists and is not older than dictionary.txt
+        """
+        try:
+            return os.path.getmtime(self.snapshot_file) >= os.path.getmtime(self.out_dict)
+        except OSError:
+            return False
+
+    def map_postings(self):
+        """
+                Method to memory map posting.txt. The file descriptor is closed straight away,
+                the mapping stays valid until close() is called.
+        """
+        if self.postings_map is not None:
+            return
+
+        try:
+            with open(self.out_postings, 'rb') as f:
+                self.postings_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # Missing or empty posting.txt, every term lookup returns an empty posting list
+            return
+        self.postings_view = memoryview(self.postings_map)
+
+    def prepare_engine(self):
+        """
+                Method to convert self.all_files to an int32 array for the numpy engine, so that it is not converted
+                again for every negated query
+        """
+        if self.engine == "numpy":
+            self.all_files = as_array(self.all_files)
+
+    def close(self):
+        """
+                Method to release the memory mapping of posting.txt and of the dictionary snapshot
+        """
+        self.dictionary.close()
+        if self.postings_view is not None:
+            self.postings_view.release()
+            self.postings_view = None
+        if self.postings_map is not None:
+            self.postings_map.close()
+            self.postings_map = None
 
     def get_posting_list_for_term(self, term):
         """
@@ -346,25 +516,108 @@ class InvertedIndex:
                 Params:
                     term: term value
                 Returns:
-                    Returns the list of posting list for given term
+                    Returns the list of integer doc ids for given term
+        """
+        postings = self.get_postings_for_term(term)
+        if isinstance(postings, list):
+            return postings
+        return postings.tolist() if self.engine == "numpy" else postings.to_list()
+
+    def get_postings_for_term(self, term):
+        """
+                Method to obtain the posting list of input term in the form it is stored in.
+                Params:
+                    term: term value
+                Returns:
+                    Returns the list of integer doc ids for given term, or a Bitmap if it is stored as a bitmap.
+                    With the numpy engine, returns an int32 array of doc ids instead.
+                    The returned posting list may be shared with the cache, and must not be modified.
         """
+        postings = self.postings_cache.get(term)
+        if postings is not None:
+            return postings
 
         try:
             size_of_posting_list, offset = self.dictionary[term]
-            line = self.read_from_file(self.out_postings, int(offset))
-            split_line = line.rstrip('\n').split(" ")[1:]
-            return split_line
-        except:
+        except KeyError:
             # Term not found
             return []
 
+        if self.postings_view is None:
+            return []
+
+        if self.engine == "numpy":
+            postings = decode_postings_array(self.postings_view, offset)
+        else:
+            size, kind, body_len, body_pos = decode_header(self.postings_view, offset)
+            if kind == POSTINGS_BITMAP:
+                postings = decode_containers(self.postings_view, body_pos, body_pos + body_len)
+            else:
+                postings = decode_body(self.postings_view, body_pos, body_pos + body_len)
+        self.postings_cache.put(term, postings)
+        return postings
+
+    def get_cursor_for_term(self, term):
+        """
+                Method to read the posting list of input term one doc id at a time, skipping ahead with advance().
+                Params:
+                    term: term value
+                Returns:
+                    Returns a PostingsCursor over the posting list of the given term, or None if it has no posting list.
+                    Posting lists stored as bitmaps are returned as a Bitmap, which is searched directly.
+                    With the numpy engine, returns the posting list as an int32 array, which is binary searched.
+                    Posting lists found in the cache are returned decoded.
+        """
+        try:
+            size_of_posting_list, offset = self.dictionary[term]
+        except KeyError:
+            return None
+
+        if self.postings_view is None:
+            return None
+
+        if self.engine != "numpy":
+            size, kind, body_len, body_pos = decode_header(self.postings_view, offset)
+            if kind != POSTINGS_BITMAP:
+                # Not cached, as the cursor decodes only the parts of the posting list it skips to. The list is
+                # only in the cache if get_postings_for_term decoded it, so not finding it there is not a miss
+                if term in self.postings_cache:
+                    return self.postings_cache.get(term)
+                return PostingsCursor(self.postings_view, offset)
+
+        postings = self.postings_cache.get(term)
+        if postings is not None:
+            return postings
+        if self.engine == "numpy":
+            postings = decode_postings_array(self.postings_view, offset)
+        else:
+            postings = decode_containers(self.postings_view, body_pos, body_pos + body_len)
+        self.postings_cache.put(term, postings)
+        return postings
+
     def get_size_for_term(self, term):
         try:
             size_of_posting_list, offset = self.dictionary[term]
-            return int(size_of_posting_list)
-        except:
+            return size_of_posting_list
+        except KeyError:
             return 0
 
+    def get_doc_ranges(self, num_ranges):
+        """
+                Method to split the doc ids into contiguous ranges of about the same number of docs.
+                Params:
+                    num_ranges: Number of ranges
+                Returns:
+                    Returns a list of (start, end) tuples in increasing order, each covering the doc ids
+                    start <= doc id < end
+        """
+        num_docs = len(self.all_files)
+        if num_docs == 0:
+            return []
+        starts = sorted(set([int(self.all_files[num_docs * i // num_ranges]) for i in range(num_ranges)]))
+        ends = starts[1:] + [int(self.all_files[-1]) + 1]
+        return list(zip(starts, ends))
+
     def read_from_file(self, in_file, offset=None, f=None, num_lines=1):
         """
                 Method to Read in the contents of in_file.
@@ -378,7 +631,8 @@ class InvertedIndex:
         """
 
         if f == None:
-            f = open(in_file, 'r')
+            with open(in_file, 'r') as f:
+                return self.read_from_file(in_file, offset, f, num_lines)
 
         if offset == None:
             return f.readlines()
@@ -397,42 +651,121 @@ class InvertedIndex:
             return lines
 
 
-class QueueItem:
-    def __init__(self, line, block_num):
-        line = line.rstrip('\n').strip(' ')
-        split_line = line.split(" ")
-        self.term = split_line[0]  # What is the term
-        self.posting_list = line.split(" ")[1:]  # Remove first item
-        self.block_num = block_num  # Tell us what block file this item comes from
+def get_postings_size(postings):
+    """
+        Approximate number of bytes taken by a decoded posting list: a list and its int objects, a Bitmap and its
+        flag per doc id (see Bitmap.get_flags), or an array
+    """
+    if isinstance(postings, list):
+        return sys.getsizeof(postings) + len(postings) * sys.getsizeof(1 << 16)
+    if isinstance(postings, Bitmap):
+        return sys.getsizeof(postings.bits) + postings.bits.bit_length()
+    return sys.getsizeof(postings)
 
-    def get_term(self):
-        return self.term
 
-    def get_posting_list(self):
-        return self.posting_list
+class InvertedIndexRange:
+    """
+        View of an InvertedIndex restricted to the doc ids start <= doc id < end, with the methods used by query.py,
+        so that a query evaluated against it returns the documents of that range only. search.py -R evaluates a
+        query over contiguous ranges in parallel, and concatenates the results.
+        - Gap encoded posting lists are read with a PostingsCursor, which skips to start with the skip table and
+          stops decoding at end. Bitmaps are masked to the range.
+        - all_files only holds the doc ids of the range, so that NOT is taken within the range.
+        - Posting lists of the range are cached in the posting list cache of the index, by term and range. Query
+          results are not cached, as the result cache of the index is keyed by the query alone.
+    """
 
-    def get_block_num(self):
-        return int(self.block_num)
+    def __init__(self, inverted_index, start, end):
+        self.inverted_index = inverted_index
+        self.start = start
+        self.end = end
+        all_files = inverted_index.all_files
+        self.all_files = all_files[bisect_left(all_files, start):bisect_left(all_files, end)]
+        self.result_cache = LRUCache(0, get_postings_size)
 
-    # We compare by term values first. If two items have the same term values, then we will
-    # compare their block number.
-    def __eq__(self, other):
-        return ((self.term, int(self.block_num)) == (other.get_term(), other.get_block_num()))
+    def get_postings_for_term(self, term):
+        """
+                Method to obtain the doc ids of the posting list of input term within the range, as a list,
+                a Bitmap, or an int32 array with the numpy engine. See InvertedIndex.get_postings_for_term
+        """
+        inverted_index = self.inverted_index
+        key = (term, self.start, self.end)
+        postings = inverted_index.postings_cache.get(key)
+        if postings is not None:
+            return postings
 
-    def __ne__(self, other):
-        return ((self.term, int(self.block_num)) != (other.get_term(), other.get_block_num()))
+        try:
+            size_of_posting_list, offset = inverted_index.dictionary[term]
+        except KeyError:
+            return []
 
-    def __lt__(self, other):
-        return ((self.term, int(self.block_num)) < (other.get_term(), other.get_block_num()))
+        if inverted_index.postings_view is None:
+            return []
+
+        size, kind, body_len, body_pos = decode_header(inverted_index.postings_view, offset)
+        if kind == POSTINGS_BITMAP:
+            bitmap = decode_containers(inverted_index.postings_view, body_pos, body_pos + body_len)
+            postings = Bitmap(bitmap.bits & ((1 << self.end) - (1 << self.start)))
+            if inverted_index.engine == "numpy":
+                postings = bitmap_to_array(postings)
+        else:
+            cursor = PostingsCursor(inverted_index.postings_view, offset)
+            postings = cursor.take_until(self.end) if cursor.advance(self.start) is not None else []
+            if inverted_index.engine == "numpy":
+                postings = as_array(postings)
+        inverted_index.postings_cache.put(key, postings)
+        return postings
+
+    def get_cursor_for_term(self, term):
+        """
+                The posting lists of a range are short, and are returned decoded rather than as a cursor
+        """
+        return self.get_postings_for_term(term)
+
+    def get_size_for_term(self, term):
+        """
+                Estimated size of the posting list of term within the range, only used to plan queries.
+                It is only 0 if the term has no posting list at all.
+        """
+        return min(self.inverted_index.get_size_for_term(term), len(self.all_files))
+
+
+def get_peak_rss():
+    """
+        Peak resident set size of the current process in bytes since it started, or None if it can not be read
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, in kilobytes elsewhere
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
 
-    def __le__(self, other):
-        return ((self.term, int(self.block_num)) <= (other.get_term(), other.get_block_num()))
 
-    def __gt__(self, other):
-        return ((self.term, int(self.block_num)) > (other.get_term(), other.get_block_num()))
+def print_block(block_name, block_time, block_bytes):
+    peak_rss = get_peak_rss()
+    # The peak is that of the whole process so far, not of this block alone
+    print("Create block {} ({:.2f}s, ~{:.1f}MB of postings{})".format(
+        block_name, block_time, block_bytes / (1024 * 1024),
+        ", process peak RSS {:.1f}MB".format(peak_rss / (1024 * 1024)) if peak_rss != None else ""))
 
-    def __ge__(self, other):
-        return ((self.term, int(self.block_num)) >= (other.get_term(), other.get_block_num()))
 
-    def __repr__(self):
-        return "%s %s" % (self.term, int(self.block_num))
\ No newline at end of file
+def read_block(block_file, block_num, buffer_bytes):
+    """
+        Generator of the lines of a block file, as tuples of (term, block_num, doc ids separated by spaces)
+    """
+    with open(block_file, 'r', buffering=buffer_bytes) as f:
+        for line in f:
+            term, _, doc_ids = line.rstrip("\n").partition(" ")
+            yield term, block_num, doc_ids
+
+
+def build_blocks_for_range(args):
+    """
+        Entry point of the processes started by InvertedIndex.build_blocks_in_parallel
+        Params:
+            args: Tuple of (in_dir, out_dict, out_postings, tokenizer, doc_ids, block_prefix, block_bytes)
+        Returns:
+            Number of blocks written
+    """
+    in_dir, out_dict, out_postings, tokenizer, doc_ids, block_prefix, block_bytes = args
+    return InvertedIndex(in_dir, out_dict, out_postings, tokenizer).build_blocks(doc_ids, block_prefix, block_bytes)
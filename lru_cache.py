@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+        Cache bounded by the total size of its values in bytes, evicting the least recently used entries first.
+        sizeof(value) gives the size of a value in bytes. A value larger than the whole budget is not cached,
+        and a budget of 0 disables the cache.
+        Entries are kept in an OrderedDict from the least to the most recently used, so that looking up, adding
+        and evicting an entry all take constant time.
+    """
+
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # key -> (value, size of value)
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+            Returns the value cached for key, or None.
+            Lookups in a disabled cache are neither hits nor misses.
+        """
+        if self.max_bytes == 0:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key)[1]
+        while self.num_bytes + size > self.max_bytes:
+            evicted_value, evicted_size = self.entries.popitem(last=False)[1]
+            self.num_bytes -= evicted_size
+            self.evictions += 1
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return "{} hits, {} misses ({:.1f}% hit rate), {} evictions, {} entries in {} bytes".format(
+            self.hits, self.misses, 100 * self.hits / lookups if lookups > 0 else 0, self.evictions,
+            len(self.entries), self.num_bytes)
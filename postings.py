@@ -0,0 +1,333 @@
+"""
+    Binary postings list format used by postings.txt.
+    Each posting list is stored at the byte offset recorded in dictionary.txt as
+        <header> <skips> <body>
+    header: variable byte encoded (number of doc ids, kind of list, length of body in bytes)
+    Lists of kind POSTINGS_GAPS are made of
+        skips: multi-level skip table, see below
+        body: variable byte encoded gaps between consecutive doc ids. The first gap is the first doc id itself.
+    Lists of kind POSTINGS_BITMAP have no skips, and their body is a sequence of Roaring style containers, see below.
+
+    Skip level l (starting from 0) has an entry for every SKIP_INTERVAL ** (l + 1)-th doc id of the list, except
+    the first one. An entry is made of the doc id and the position in body right after the gap of that doc id.
+    The position of the doc id in the list is implied by the entry number, so decoding can resume from any entry.
+    Every level is stored as the doc ids of all its entries followed by their positions, as native 4 byte
+    unsigned ints. Levels are stored from the top (sparsest) level down, and their number and sizes follow from
+    the number of doc ids. Lists of at most SKIP_INTERVAL doc ids have no skips.
+
+    Bitmap lists split doc ids into chunks of 2 ** CHUNK_BITS doc ids, the chunk of a doc id being its high bits.
+    Every chunk with at least one doc id is stored as a container, in increasing order of chunks, as
+        <chunk> <kind of container> <length of payload in bytes> <payload>
+    the first three being variable byte encoded. The payload of a CONTAINER_ARRAY is the variable byte encoded gaps
+    of the low bits of the doc ids, like a body without skips. The payload of a CONTAINER_BITMAP has a bit per doc id
+    of the chunk, as the little endian bytes of an int where bit i stands for the i-th doc id of the chunk, without
+    trailing zero bytes. Each container takes whichever kind is smaller, so sparse chunks are stored as arrays as in
+    Roaring bitmaps (Chambi et al. 2016). A list is stored as a bitmap list when that takes fewer bytes than its gaps
+    and skips, which is the case for terms found in roughly one out of 8 doc ids or more.
+
+    Variable byte encoding follows Introduction to Information Retrieval (Manning et al.) Chapter 5.3:
+    7 bits of payload per byte, and the high bit is set on the last byte of every number.
+
+    The decoders take any buffer that supports indexing and slicing, such as the memoryview over the
+    memory mapped posting.txt, so posting lists are decoded in place without copying the file contents.
+"""
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+from bitmap import Bitmap
+
+SKIP_INTERVAL = 16
+
+POSTINGS_GAPS = 0
+POSTINGS_BITMAP = 1
+
+CHUNK_BITS = 16
+CONTAINER_ARRAY = 0
+CONTAINER_BITMAP = 1
+
+
+def vb_encode_number(n, out):
+    """
+        Appends the variable byte encoding of n to the bytearray out
+    """
+    chunks = [(n & 0x7f) | 0x80]
+    n >>= 7
+    while n > 0:
+        chunks.append(n & 0x7f)
+        n >>= 7
+    out.extend(reversed(chunks))
+
+
+def vb_decode_number(buf, pos):
+    """
+        Decodes a single variable byte encoded number from buf starting at pos.
+        Returns a tuple of (number, position after the number)
+    """
+    n = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        if b < 128:
+            n = (n << 7) | b
+        else:
+            return (n << 7) | (b - 128), pos
+
+
+def get_num_skips(size, level):
+    """
+        Number of entries in the given skip level of a list of size doc ids
+    """
+    return max(size - 1, 0) // SKIP_INTERVAL ** (level + 1)
+
+
+def get_num_skip_levels(size):
+    num_levels = 0
+    while get_num_skips(size, num_levels) > 0:
+        num_levels += 1
+    return num_levels
+
+
+def encode_postings(doc_ids):
+    """
+        Encodes a sorted list of integer doc ids into header + skip table + gap encoded body, or into header +
+        bitmap containers if that is smaller
+    """
+    body = bytearray()
+    # Position in body after the gap of every doc id
+    positions = []
+    prev = 0
+    for doc_id in doc_ids:
+        vb_encode_number(doc_id - prev, body)
+        positions.append(len(body))
+        prev = doc_id
+
+    skips = array('I')
+    for level in reversed(range(get_num_skip_levels(len(doc_ids)))):
+        stride = SKIP_INTERVAL ** (level + 1)
+        skips.extend(doc_ids[stride::stride])
+        skips.extend(positions[stride::stride])
+
+    kind = POSTINGS_GAPS
+    skips = skips.tobytes()
+    # A bitmap takes at least a byte per 8 doc ids of the chunks it spans, while gaps take at least a byte per doc id
+    if len(doc_ids) > 0 and len(doc_ids) * 8 >= doc_ids[-1] - (doc_ids[0] >> CHUNK_BITS << CHUNK_BITS):
+        containers = encode_containers(doc_ids)
+        if len(containers) < len(skips) + len(body):
+            kind = POSTINGS_BITMAP
+            skips = b""
+            body = containers
+
+    out = bytearray()
+    vb_encode_number(len(doc_ids), out)
+    vb_encode_number(kind, out)
+    vb_encode_number(len(body), out)
+    out += skips
+    out += body
+    return bytes(out)
+
+
+def encode_containers(doc_ids):
+    """
+        Encodes a sorted list of integer doc ids into Roaring style containers
+    """
+    out = bytearray()
+    start = 0
+    while start < len(doc_ids):
+        chunk = doc_ids[start] >> CHUNK_BITS
+        end = start
+        while end < len(doc_ids) and doc_ids[end] >> CHUNK_BITS == chunk:
+            end += 1
+        low_bits = [doc_id - (chunk << CHUNK_BITS) for doc_id in doc_ids[start:end]]
+
+        array_payload = bytearray()
+        prev = 0
+        for low in low_bits:
+            vb_encode_number(low - prev, array_payload)
+            prev = low
+        bits = 0
+        for low in low_bits:
+            bits |= 1 << low
+        bitmap_payload = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+        vb_encode_number(chunk, out)
+        if len(bitmap_payload) < len(array_payload):
+            vb_encode_number(CONTAINER_BITMAP, out)
+            vb_encode_number(len(bitmap_payload), out)
+            out += bitmap_payload
+        else:
+            vb_encode_number(CONTAINER_ARRAY, out)
+            vb_encode_number(len(array_payload), out)
+            out += array_payload
+        start = end
+    return bytes(out)
+
+
+def decode_header(buf, pos=0):
+    """
+        Returns a tuple of (number of doc ids, kind of list, length of body, position of body)
+    """
+    size, kind, body_len, skips_pos = decode_lengths(buf, pos)
+    if kind == POSTINGS_BITMAP:
+        return size, kind, body_len, skips_pos
+    num_skips = sum([get_num_skips(size, level) for level in range(get_num_skip_levels(size))])
+    return size, kind, body_len, skips_pos + num_skips * 2 * array('I').itemsize
+
+
+def decode_lengths(buf, pos=0):
+    """
+        Returns a tuple of (number of doc ids, kind of list, length of body, position of skip table)
+    """
+    size, pos = vb_decode_number(buf, pos)
+    kind, pos = vb_decode_number(buf, pos)
+    body_len, pos = vb_decode_number(buf, pos)
+    return size, kind, body_len, pos
+
+
+def decode_body(buf, start, end):
+    """
+        Decodes the gap encoded body in buf[start:end] back into a list of integer doc ids.
+        Slicing a memoryview does not copy, so buf should be a memoryview when it is backed by a mapped file.
+    """
+    gaps = []
+    n = 0
+    for b in buf[start:end]:
+        if b < 128:
+            n = (n << 7) | b
+        else:
+            gaps.append((n << 7) | (b - 128))
+            n = 0
+    return list(accumulate(gaps))
+
+
+def decode_containers(buf, start, end):
+    """
+        Decodes the Roaring style containers in buf[start:end] into a Bitmap
+    """
+    bits = 0
+    pos = start
+    while pos < end:
+        chunk, pos = vb_decode_number(buf, pos)
+        container_kind, pos = vb_decode_number(buf, pos)
+        payload_len, pos = vb_decode_number(buf, pos)
+        if container_kind == CONTAINER_BITMAP:
+            chunk_bits = int.from_bytes(buf[pos:pos + payload_len], 'little')
+        else:
+            chunk_bits = Bitmap.from_list(decode_body(buf, pos, pos + payload_len)).bits
+        bits |= chunk_bits << (chunk << CHUNK_BITS)
+        pos += payload_len
+    return Bitmap(bits)
+
+
+class PostingsCursor:
+    """
+        Reads a posting list of kind POSTINGS_GAPS one doc id at a time, directly from buf.
+        advance(target) uses the skip table to jump close to target: starting from the top level, it finds the last
+        entry of a level that is not past target, then continues one level down. Since every entry of a level spans
+        at most SKIP_INTERVAL entries of the level below, only SKIP_INTERVAL entries are binary searched per level
+        below the top one, after which at most SKIP_INTERVAL - 1 gaps are decoded.
+    """
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.size, kind, body_len, pos = decode_lengths(buf, pos)
+        # Memoryviews of the doc ids and positions in body of the entries of every skip level
+        num_levels = get_num_skip_levels(self.size)
+        self.skip_docs = [None] * num_levels
+        self.skip_positions = [None] * num_levels
+        for level in reversed(range(num_levels)):
+            level_len = get_num_skips(self.size, level) * array('I').itemsize
+            self.skip_docs[level] = buf[pos:pos + level_len].cast('I')
+            pos += level_len
+            self.skip_positions[level] = buf[pos:pos + level_len].cast('I')
+            pos += level_len
+        self.body_start = pos
+        self.body_end = pos + body_len
+        # Position of the next gap in buf, and index and value of the current doc id
+        self.pos = pos
+        self.index = -1
+        self.doc = 0
+
+    def __len__(self):
+        return self.size
+
+    def to_list(self):
+        """
+            Decodes the whole list at once, regardless of the current position
+        """
+        return decode_body(self.buf, self.body_start, self.body_end)
+
+    def next(self):
+        """
+            Moves to the next doc id and returns it, or None at the end of the list
+        """
+        if self.index + 1 >= self.size:
+            self.index = self.size
+            return None
+        gap, self.pos = vb_decode_number(self.buf, self.pos)
+        self.doc += gap
+        self.index += 1
+        return self.doc
+
+    def advance(self, target):
+        """
+            Moves to the first doc id >= target, from the current one onwards, and returns it.
+            Returns None if there is no such doc id.
+        """
+        if self.index >= self.size:
+            return None
+        if self.index >= 0 and self.doc >= target:
+            return self.doc
+
+        for level in reversed(range(len(self.skip_docs))):
+            skip_docs = self.skip_docs[level]
+            stride = SKIP_INTERVAL ** (level + 1)
+            # Entry i is the (i + 1) * stride-th doc id. Search from the first entry after the current doc id,
+            # up to the first entry of the level above that is past target
+            lo = max(self.index // stride, 0)
+            hi = len(skip_docs)
+            if level < len(self.skip_docs) - 1:
+                hi = min(lo + SKIP_INTERVAL, hi)
+            i = bisect_right(skip_docs, target, lo, hi)
+            if i > 0 and i * stride > self.index:
+                self.index = i * stride
+                self.doc = skip_docs[i - 1]
+                self.pos = self.body_start + self.skip_positions[level][i - 1]
+
+        # Decode the remaining gaps, as in vb_decode_number
+        buf = self.buf
+        pos = self.pos
+        doc = self.doc
+        index = self.index
+        while index < 0 or doc < target:
+            if index + 1 >= self.size:
+                self.index = self.size
+                return None
+            gap = 0
+            while True:
+                b = buf[pos]
+                pos += 1
+                if b < 128:
+                    gap = (gap << 7) | b
+                else:
+                    gap = (gap << 7) | (b - 128)
+                    break
+            doc += gap
+            index += 1
+        self.pos = pos
+        self.doc = doc
+        self.index = index
+        return doc
+
+    def take_until(self, end):
+        """
+            Returns the doc ids < end from the current one onwards, and moves to the first doc id >= end.
+            Call advance() first to start at a given doc id.
+        """
+        if self.index < 0:
+            self.next()
+        out = []
+        while self.index < self.size and self.doc < end:
+            out.append(self.doc)
+            self.next()
+        return out
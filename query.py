@@ -1,26 +1,140 @@
 import string
-from math import ceil, sqrt
+from bisect import bisect_left
+from heapq import merge
 import nltk
 
+from bitmap import Bitmap
+from cursors import ListCursor, AndCursor, OrCursor, NotCursor, as_cursor
 from inverted_index import InvertedIndex
+from postings import PostingsCursor
+import vectorized
+from vectorized import is_array
 
 stemmer = nltk.PorterStemmer()
 translator = str.maketrans('', '', string.punctuation)
 
 class Query:
     def __init__(self):
-        self.is_flipped = False
         self.is_primitive = False
-        pass
+        # Number of documents returned by the last evaluate_signed, and whether they were negated
+        self.size = None
+        self.is_negated = False
+        # Set by plan(). Estimated number of documents satisfying the query, whether evaluate_signed will return
+        # a negated result, and whether the query provably matches no document or every document
+        self.estimated_size = None
+        self.evaluates_negated = False
+        self.is_empty = False
+        self.is_full = False
+        # Canonical form of the query, set by canonicalize(), and result of evaluate_signed once evaluated
+        self.key = None
+        self.result = None
+
+    def evaluate(self, inverted_index, forced=True):
+        """
+        Return a list of documents that satisfies the query.
+        The complement of a negated result is only built here, against all doc ids, for the top-level query.
+        With forced=False, the documents of a negated result are returned as they are instead.
+        """
+        self.plan(inverted_index)
+        docs, is_negated = self.evaluate_signed(inverted_index)
+        if is_negated and forced:
+            docs = difference(inverted_index.all_files, docs)
+        if isinstance(docs, Bitmap):
+            return docs.to_list()
+        if is_array(docs):
+            return docs.tolist()
+        return docs
+
+    def evaluate_iter(self, inverted_index):
+        """
+        Streaming counterpart of evaluate: yields the documents that satisfy the query in increasing order, as they
+        are pulled from the cursor of the query (see stream). No list of documents is built, and results are not
+        cached.
+        """
+        self.plan(inverted_index)
+        cursor = self.stream(inverted_index)
+        doc = cursor.next()
+        while doc is not None:
+            yield doc
+            doc = cursor.next()
+
+    def stream(self, inverted_index):
+        """
+        Return a cursor over the documents that satisfy the query, with next() and advance(target) (see cursors.py).
+        Operands are streamed in the order chosen by plan(), which must have been run first.
+        """
+        if self.is_empty:
+            return ListCursor([])
+        if self.is_full:
+            return ListCursor(inverted_index.all_files)
+        return self._stream(inverted_index)
+
+    def _stream(self, inverted_index):
+        raise NotImplementedError("stream not implemented")
+
+    def evaluate_signed(self, inverted_index):
+        """
+        Return a tuple of (list of documents, is_negated). If is_negated is True, the query is satisfied by every
+        document except the returned ones, so that NOT never needs the list of all doc ids within a query.
+        Dense lists of documents are returned as a Bitmap instead of a list.
+        The result is kept on the query, so that a sub query shared by several operands (see canonicalize) is
+        evaluated once. Results of canonical AND and OR queries are also kept in the result cache of inverted_index,
+        to be reused by the following queries.
+        """
+        if self.result is not None:
+            return self.result
+        cacheable = not self.is_primitive and self.key is not None
+        result = inverted_index.result_cache.get(self.key) if cacheable else None
+        if result is None:
+            result = self._evaluate_signed(inverted_index)
+            if cacheable:
+                inverted_index.result_cache.put(self.key, result)
+        else:
+            self.size = len(result[0])
+            self.is_negated = result[1]
+        self.result = result
+        return result
+
+    def _evaluate_signed(self, inverted_index):
+        raise NotImplementedError("evaluate_signed not implemented")
 
-    def evaluate(self, inverted_index, forced=False):
+    def canonicalize(self, nodes):
         """
-        Return a list of documents that satisfies the query
+        Return the canonical form of the query: AND and OR are flattened, their operands are sorted and repeated
+        operands are dropped, and NOT NOT a becomes a. Sets the key of every sub query to a string of its
+        canonical form, so that equivalent queries have the same key.
+        nodes maps the keys seen so far to their query, and every sub query is replaced by the query already
+        in nodes with the same key, so that common sub queries are shared and only evaluated once.
         """
-        raise NotImplementedError("evaluate not implemented")
+        raise NotImplementedError("canonicalize not implemented")
+
+    def plan(self, inverted_index):
+        """
+        Planning pass over the query, run by evaluate before anything is evaluated.
+        Estimates the number of matching documents bottom-up from document frequencies, marks sub queries that
+        provably match no document or every document so that they are not evaluated, and orders the operands
+        of AND and OR.
+        """
+        raise NotImplementedError("plan not implemented")
+
+    def get_estimated_docs(self, inverted_index):
+        """
+        Return the estimated number of documents returned by evaluate_signed, ie. of the complement if negated
+        """
+        if self.evaluates_negated:
+            return len(inverted_index.all_files) - self.estimated_size
+        return self.estimated_size
 
     def get_size(self, inverted_index):
-        raise NotImplementedError("getSize not implemented")
+        """
+        Return the number of documents that satisfied the query when it was last evaluated,
+        or the estimate if it has not been evaluated yet
+        """
+        if self.size is None:
+            return self.estimated_size
+        if self.is_negated:
+            return len(inverted_index.all_files) - self.size
+        return self.size
 
     def __str__(self):
         return "Query"
@@ -32,27 +146,31 @@ class QueryTerm(Query):
         self.is_primitive = True
         self.term = stemmer.stem(term.strip().translate(translator).lower())
 
-    def evaluate(self, inverted_index, forced=False):
-        """
-        Returns a list of integers
-        """
-        docs = [int(op.split(";")[0]) for op in inverted_index.get_posting_list_for_term(self.term)]
-        return docs
+    def canonicalize(self, nodes):
+        self.key = self.term
+        return nodes.setdefault(self.key, self)
+
+    def plan(self, inverted_index):
+        self.result = None
+        # Document frequencies are exact
+        self.estimated_size = self.get_size(inverted_index)
+        self.is_empty = self.estimated_size == 0
+
+    def _evaluate_signed(self, inverted_index):
+        return inverted_index.get_postings_for_term(self.term), False
 
-    def _evaluate(self, inverted_index):
+    def _stream(self, inverted_index):
+        return as_cursor(self.get_cursor(inverted_index))
+
+    def get_cursor(self, inverted_index):
         """
-        Returns a list of tuples (curr, next) where curr is the doc_id and next is the value of the next skip val if exist.
-        Otherwise, next will be -1 if no skip is allowed for that doc.
+        Returns a PostingsCursor over the posting list of the term, a Bitmap if the posting list is stored as a bitmap,
+        or an empty list if the term is not indexed
         """
-        docs = []
-        for op in inverted_index.get_posting_list_for_term(self.term):
-            split_op = op.split(";")
-            curr = split_op[0]
-            next = -1
-            if len(split_op) == 2:
-                next = split_op[1]
-            docs.append((int(curr), int(next)))
-        return docs
+        cursor = inverted_index.get_cursor_for_term(self.term)
+        if cursor is None:
+            return []
+        return cursor
 
     def get_size(self, inverted_index):
         return inverted_index.get_size_for_term(self.term)
@@ -66,7 +184,8 @@ class QueryOr(Query):
         super().__init__()
         self.ops = ops
         self.ops = self._flatten_ops()
-        self.size = None
+        # Operands in evaluation order, set by plan()
+        self.plan_ops = self.ops
 
     def _flatten_ops(self):
         ops = []
@@ -79,60 +198,215 @@ class QueryOr(Query):
 
         return ops
 
-    def evaluate(self, inverted_index, forced=False):
-        ops = [op.evaluate(inverted_index, forced=True) for op in self.ops]
-        union = ops[0]
-        for op in ops[1:]:
-            union = merge_or(union, op)
-
-        self.size = len(union)
-
-        return union
-
-    def get_size(self, inverted_index):
-        return self.size
+    def canonicalize(self, nodes):
+        self.ops = [op.canonicalize(nodes) for op in self.ops]
+        self.ops = self._flatten_ops()
+        ops = {op.key: op for op in self.ops}
+        if len(ops) == 1:
+            return self.ops[0]
+        self.ops = [ops[key] for key in sorted(ops)]
+        self.plan_ops = self.ops
+        self.key = "(" + "∨".join([op.key for op in self.ops]) + ")"
+        return nodes.setdefault(self.key, self)
+
+    def plan(self, inverted_index):
+        self.result = None
+        num_docs = len(inverted_index.all_files)
+        for op in self.ops:
+            op.plan(inverted_index)
+
+        # Union bound
+        self.estimated_size = min(num_docs, sum([op.estimated_size for op in self.ops]))
+        self.is_empty = all([op.is_empty for op in self.ops])
+        self.is_full = any([op.is_full for op in self.ops])
+
+        # Empty operands do not change the union. Negated operands first, as they can make the union match every
+        # document (see evaluate_signed), then smaller lists first, for pairwise merging
+        self.plan_ops = sorted([op for op in self.ops if not op.is_empty],
+                               key=lambda op: (not op.evaluates_negated, op.get_estimated_docs(inverted_index)))
+        self.evaluates_negated = any([op.evaluates_negated for op in self.plan_ops])
+
+    def _evaluate_signed(self, inverted_index):
+        if self.is_empty:
+            return [], False
+        if self.is_full:
+            return [], True
+
+        add_lists = []
+        # De Morgan's Law: a OR NOT b OR NOT c = NOT ((b AND c) AND NOT a). negated is b AND c
+        negated = None
+        for op in self.plan_ops:
+            if negated is not None and len(negated) == 0:
+                # Every document matches, whatever the remaining operands are
+                break
+            docs, is_negated = op.evaluate_signed(inverted_index)
+            if not is_negated:
+                add_lists.append(docs)
+            elif negated is None:
+                negated = docs
+            else:
+                negated = intersect(negated, docs)
+
+        if negated is None:
+            union = merge_or_all(add_lists)
+            self.size = len(union)
+            self.is_negated = False
+            return union, False
+
+        docs = difference(negated, merge_or_all(add_lists))
+        self.size = len(docs)
+        self.is_negated = True
+        return docs, True
+
+    def _stream(self, inverted_index):
+        add_ops = [op for op in self.plan_ops if not isinstance(op, QueryNot)]
+        negate_ops = [op.op for op in self.plan_ops if isinstance(op, QueryNot)]
+        if len(negate_ops) > 0:
+            # De Morgan's Law: a OR NOT b OR NOT c = NOT ((b AND c) AND NOT a), so that only one cursor runs over
+            # all doc ids
+            negated = AndCursor([op.stream(inverted_index) for op in negate_ops],
+                                [op.stream(inverted_index) for op in add_ops])
+            return NotCursor(negated, ListCursor(inverted_index.all_files))
+        if len(add_ops) == 1:
+            return add_ops[0].stream(inverted_index)
+        return OrCursor([op.stream(inverted_index) for op in add_ops])
 
     def __str__(self):
         return "∨".join([op.__str__() for op in self.ops])
 
 
-def merge_two_lists(list1, list2, list1_size, list2_size):
+# Lists at least this many times larger than the other list are searched instead of merged
+SEARCH_SIZE_RATIO = 3
+# Posting lists at least this many times larger than the other list are skipped through with their skip table
+# instead of being decoded in full. Below this, decoding the whole list is cheaper than decoding gap by gap.
+SKIP_SIZE_RATIO = 32
+# Bitmaps with less than one document per this many doc ids are turned back into lists
+BITMAP_DENSITY = 64
+
+
+def compact(bitmap):
     """
-        Takes in 2 lists.
-        Each list contains items of the format : (curr_doc_id, next_doc_id) where next_doc_id is the next skip
-        The output is a single list of the same format
+        Returns bitmap, or the list of its doc ids if it has become sparse
     """
-    jump_1 = ceil(sqrt(list1_size))
-    jump_2 = ceil(sqrt(list2_size))
+    if len(bitmap) * BITMAP_DENSITY < bitmap.bits.bit_length():
+        return bitmap.to_list()
+    return bitmap
 
-    if list1_size == 0:
-        list1_size = len(list1)
 
-    merged_list = []
-    i = 0
-    j = 0
+def to_bitmap(docs):
+    if isinstance(docs, Bitmap):
+        return docs
+    if isinstance(docs, PostingsCursor):
+        docs = docs.to_list()
+    return Bitmap.from_list(docs)
 
-    while i < list1_size and j < list2_size:
-        item_1 = list1[i]
-        item_2 = list2[j]
-        if item_1[0] == item_2[0]:
-            merged_list.append(item_1)
+
+def merge_and(l1, l2):
+    """
+        Intersection of two sorted lists of doc ids by walking both lists
+    """
+    i = j = 0
+    len1 = len(l1)
+    len2 = len(l2)
+    out = []
+
+    while i < len1 and j < len2:
+        if l1[i] == l2[j]:
+            out.append(l1[i])
             i += 1
             j += 1
-        elif item_1[0] < item_2[0]:
-            # Has skip pointer
-            if item_1[1] != -1 and item_1[1] < item_2[0]:
-                i += jump_1
-            else:
-                i += 1
+        elif l1[i] > l2[j]:
+            j += 1
         else:
-            # Has skip pointer
-            if item_2[1] != -1 and item_2[1] < item_1[0]:
-                j += jump_2
-            else:
-                j += 1
+            i += 1
+    return out
 
-    return merged_list
+
+def search_and(small, large):
+    """
+        Intersection of two sorted lists of doc ids, looking up every doc id of small in large with a binary search.
+        Each search starts after the previous match, so this takes time proportional to
+        len(small) * log(len(large)) rather than to len(large).
+    """
+    out = []
+    lo = 0
+    len_large = len(large)
+
+    for doc_id in small:
+        lo = bisect_left(large, doc_id, lo)
+        if lo == len_large:
+            break
+        if large[lo] == doc_id:
+            out.append(doc_id)
+            lo += 1
+    return out
+
+
+def intersect(l1, l2):
+    """
+        Intersection of two sorted lists of doc ids. The smaller list is searched in the larger one when their sizes
+        are far apart, otherwise both are merged.
+        Two bitmaps are intersected with a bitwise AND, and a list is intersected with a bitmap by looking up every
+        doc id of the list in the bitmap. Arrays are intersected by vectorized.intersect.
+    """
+    if is_array(l1) or is_array(l2):
+        return vectorized.intersect(l1, l2)
+    if isinstance(l1, Bitmap) and isinstance(l2, Bitmap):
+        return compact(l1 & l2)
+    if isinstance(l1, Bitmap):
+        return l1.select(l2)
+    if isinstance(l2, Bitmap):
+        return l2.select(l1)
+    if len(l1) > len(l2):
+        l1, l2 = l2, l1
+    if len(l1) == 0:
+        return []
+    if len(l2) >= SEARCH_SIZE_RATIO * len(l1):
+        return search_and(l1, l2)
+    return merge_and(l1, l2)
+
+
+def advance_and(docs, cursor):
+    """
+        Intersection of a sorted list of doc ids with a PostingsCursor, skipping ahead in the cursor to every doc id.
+        Only the parts of the posting list around the doc ids of docs are decoded.
+    """
+    out = []
+    for doc_id in docs:
+        doc = cursor.advance(doc_id)
+        if doc is None:
+            break
+        if doc == doc_id:
+            out.append(doc_id)
+    return out
+
+
+def intersect_all(operands):
+    """
+        Intersection of any number of sorted lists of doc ids, Bitmaps or PostingsCursors, starting from the smallest one
+        so that every intermediate result is as small as possible.
+        Cursors that are far larger than the current result are skipped through rather than decoded.
+    """
+    operands = sorted(operands, key=len)
+    merged = operands[0]
+    if isinstance(merged, PostingsCursor):
+        merged = merged.to_list()
+    for op in operands[1:]:
+        if len(merged) == 0:
+            break
+        merged = intersect_operand(merged, op)
+    return merged
+
+
+def intersect_operand(merged, op):
+    """
+        Intersection of a sorted list of doc ids or a Bitmap with a sorted list of doc ids, a Bitmap or a PostingsCursor
+    """
+    if isinstance(op, PostingsCursor):
+        if not isinstance(merged, Bitmap) and len(op) >= SKIP_SIZE_RATIO * len(merged):
+            return advance_and(merged, op)
+        op = op.to_list()
+    return intersect(merged, op)
 
 
 def merge_or(l1, l2):
@@ -166,7 +440,52 @@ def merge_or(l1, l2):
     return out
 
 
+def merge_or_all(lists):
+    """
+        Union of any number of sorted lists of doc ids in a single pass.
+        Folding the lists pairwise with merge_or copies the growing union once per list, while heapq.merge keeps
+        a heap of the smallest remaining doc id of every list, so every doc id is only visited once.
+        The heap costs more per doc id than merge_or, so up to 3 lists are still merged pairwise.
+        If any of the lists is a Bitmap, the union is a bitwise OR of all of them as bitmaps.
+    """
+    lists = [l for l in lists if len(l) > 0]
+    if len(lists) == 0:
+        return []
+    if any([is_array(l) for l in lists]):
+        return vectorized.union(lists)
+    if any([isinstance(l, Bitmap) for l in lists]):
+        union = Bitmap()
+        for l in lists:
+            union = union | to_bitmap(l)
+        return union
+    if len(lists) <= 3:
+        union = lists[0]
+        for l in lists[1:]:
+            union = merge_or(union, l)
+        return union
+
+    out = []
+    prev = None
+    for doc_id in merge(*lists):
+        if doc_id != prev:
+            out.append(doc_id)
+            prev = doc_id
+    return out
+
+
 def difference(l1, l2):
+    """
+        Doc ids of l1 which are not in l2. Either may be a Bitmap, in which case the doc ids of l1 are looked up in l2,
+        or both are subtracted as bitmaps if l1 is a Bitmap. Arrays are subtracted by vectorized.difference.
+    """
+    if is_array(l1) or is_array(l2):
+        return vectorized.difference(l1, l2)
+    if isinstance(l1, Bitmap):
+        if len(l2) == 0:
+            return l1
+        return compact(l1 - to_bitmap(l2))
+    if isinstance(l2, Bitmap):
+        return l2.reject(l1)
     i = j = 0
     len1 = len(l1)
     len2 = len(l2)
@@ -199,9 +518,11 @@ def difference(l1, l2):
 class QueryAnd(Query):
     def __init__(self, ops):
         super().__init__()
-        self.size = None
         self.ops = ops
         self.ops = self._flatten_ops()
+        # Operands in evaluation order, and terms at least this large are read with cursors. Set by plan()
+        self.plan_ops = self.ops
+        self.cursor_size = 0
 
     def _flatten_ops(self):
         ops = []
@@ -214,57 +535,104 @@ class QueryAnd(Query):
 
         return ops
 
-    def evaluate(self, inverted_index, **kwargs):
+    def canonicalize(self, nodes):
+        self.ops = [op.canonicalize(nodes) for op in self.ops]
+        self.ops = self._flatten_ops()
+        ops = {op.key: op for op in self.ops}
+        if len(ops) == 1:
+            return self.ops[0]
+        self.ops = [ops[key] for key in sorted(ops)]
+        self.plan_ops = self.ops
+        self.key = "(" + "∧".join([op.key for op in self.ops]) + ")"
+        return nodes.setdefault(self.key, self)
+
+    def plan(self, inverted_index):
+        self.result = None
+        num_docs = len(inverted_index.all_files)
+        for op in self.ops:
+            op.plan(inverted_index)
 
-        add_lists = [] # Format of each list item:(curr, next)
+        # Assuming the operands are independent, capped by the smallest one
+        estimated_size = num_docs
         for op in self.ops:
-            if not op.is_flipped:
-                if op.is_primitive:
-                    #isinstance(op, QueryTerm)
-                    add_lists.append((op._evaluate(inverted_index), op.get_size(inverted_index)))
-                else:
-                    list_ops = [(x, -1) for x in op.evaluate(inverted_index)]
-                    add_lists.append((list_ops, op.get_size(inverted_index)))
-
-        negate_lists = [op.evaluate(inverted_index) for op in self.ops if op.is_flipped]
-
-        # case 1, all negate
-        if len(add_lists) == 0:
-            merged = negate_lists[0]
-            for op in negate_lists[1:]:
-                merged = merge_or(merged, op)
-            all_negate = list(sorted(difference(inverted_index.all_files, merged)))
-            self.size = len(all_negate)
-            return all_negate  # todo can still be improved
-        else:
-            # Sort by evaluated op size
-            add_lists = sorted(add_lists, key=lambda x: x[1])
-
-            if len(add_lists) > 1:
-                # We have to merge more than 1 list
-                merged_ops = add_lists[0][0]
-                merged_list_size = add_lists[0][1]
-                for each_list in add_lists[1:]:
-                    merged_ops = merge_two_lists(merged_ops, each_list[0], merged_list_size, each_list[1])
-                    merged_list_size = 0 # The merged list will have no skip pointers, hence 0 jumps
-                merged = [x[0] for x in merged_ops]
+            estimated_size = estimated_size * op.estimated_size / num_docs if num_docs > 0 else 0
+        self.estimated_size = min([estimated_size] + [op.estimated_size for op in self.ops])
+        self.is_empty = any([op.is_empty for op in self.ops])
+        self.is_full = all([op.is_full for op in self.ops])
+
+        # Operands matching every document do not change the intersection
+        plan_ops = [op for op in self.ops if not op.is_full]
+        self.evaluates_negated = all([op.evaluates_negated for op in plan_ops])
+
+        # Smallest lists first. Negated operands are subtracted afterwards, the larger ones first
+        add_ops = sorted([op for op in plan_ops if not op.evaluates_negated],
+                         key=lambda op: op.get_estimated_docs(inverted_index))
+        negate_ops = sorted([op for op in plan_ops if op.evaluates_negated],
+                            key=lambda op: op.get_estimated_docs(inverted_index), reverse=True)
+        self.plan_ops = add_ops + negate_ops
+
+        # Terms far larger than the smallest operand are skipped through with cursors (see intersect_all),
+        # the others are decoded directly
+        if len(add_ops) > 0:
+            self.cursor_size = SKIP_SIZE_RATIO * add_ops[0].get_estimated_docs(inverted_index)
+
+    def _evaluate_signed(self, inverted_index):
+        if self.is_empty:
+            return [], False
+        if self.is_full:
+            return [], True
+
+        # Operands are evaluated one at a time in plan order and intersected with the result so far,
+        # so that nothing is evaluated once the result is empty
+        merged = None
+        negate_lists = []
+        for op in self.plan_ops:
+            if merged is not None and len(merged) == 0:
+                break
+            if isinstance(op, QueryTerm) and op.estimated_size >= self.cursor_size:
+                # Read with a cursor, so that a long posting list is skipped through instead of decoded
+                docs, is_negated = op.get_cursor(inverted_index), False
             else:
-                # Case where we only have 1 list in add_ops
-                merged = [x[0] for x in add_lists[0][0]]
-
-            # case 2, all add
-            if len(negate_lists) == 0:
-                self.size = len(merged)
-                return merged
+                docs, is_negated = op.evaluate_signed(inverted_index)
+
+            if is_negated and merged is not None:
+                merged = difference(merged, docs)
+            elif is_negated:
+                negate_lists.append(docs)
+            elif merged is None:
+                merged = docs.to_list() if isinstance(docs, PostingsCursor) else docs
+            else:
+                merged = intersect_operand(merged, docs)
 
-            # case 3, some add, some negate
-            for op in negate_lists:
-                merged = difference(merged, op)
+        # case 1, all negate. De Morgan's Law: NOT a AND NOT b = NOT (a OR b)
+        if merged is None:
+            merged = merge_or_all(negate_lists)
             self.size = len(merged)
-            return merged
-
-    def get_size(self, inverted_index):
-        return self.size
+            self.is_negated = True
+            return merged, True
+
+        # case 2 and 3, subtract negated operands evaluated before any other operand
+        for docs in negate_lists:
+            if len(merged) == 0:
+                break
+            merged = difference(merged, docs)
+        self.size = len(merged)
+        self.is_negated = False
+        return merged, False
+
+    def _stream(self, inverted_index):
+        # Positive operands in plan order, smallest first, drive the intersection. NOT operands are not complemented,
+        # their operand is looked up instead
+        add_ops = [op for op in self.plan_ops if not isinstance(op, QueryNot)]
+        negate_ops = [op.op for op in self.plan_ops if isinstance(op, QueryNot)]
+        if len(add_ops) == 0:
+            # De Morgan's Law: NOT a AND NOT b = NOT (a OR b)
+            return NotCursor(OrCursor([op.stream(inverted_index) for op in negate_ops]),
+                             ListCursor(inverted_index.all_files))
+        if len(add_ops) == 1 and len(negate_ops) == 0:
+            return add_ops[0].stream(inverted_index)
+        return AndCursor([op.stream(inverted_index) for op in add_ops],
+                         [op.stream(inverted_index) for op in negate_ops])
 
     def __str__(self):
         return "∧".join([op.__str__() for op in self.ops])
@@ -275,21 +643,32 @@ class QueryNot(Query):
         super().__init__()
         self.is_primitive = op.is_primitive
         self.op = op
-        self.is_flipped = not op.is_flipped
-        self.size = None
-
-    def evaluate(self, inverted_index: InvertedIndex, forced=False):
-        matches = self.op.evaluate(inverted_index)
-        if forced:
-            diff = difference(inverted_index.all_files, matches)
-            self.size = len(diff)
-            return diff
-        else:
-            self.size = len(matches)
-            return matches
 
-    def get_size(self, inverted_index):
-        return self.size
+    def canonicalize(self, nodes):
+        op = self.op.canonicalize(nodes)
+        if isinstance(op, QueryNot):
+            return op.op
+        self.op = op
+        self.is_primitive = op.is_primitive
+        self.key = "¬" + op.key
+        return nodes.setdefault(self.key, self)
+
+    def plan(self, inverted_index):
+        self.result = None
+        self.op.plan(inverted_index)
+        self.estimated_size = len(inverted_index.all_files) - self.op.estimated_size
+        self.evaluates_negated = not self.op.evaluates_negated
+        self.is_empty = self.op.is_full
+        self.is_full = self.op.is_empty
+
+    def _evaluate_signed(self, inverted_index: InvertedIndex):
+        docs, is_negated = self.op.evaluate_signed(inverted_index)
+        self.size = len(docs)
+        self.is_negated = not is_negated
+        return docs, not is_negated
+
+    def _stream(self, inverted_index):
+        return NotCursor(self.op.stream(inverted_index), ListCursor(inverted_index.all_files))
 
     def __str__(self):
         return "¬{}".format(self.op)
@@ -330,10 +709,16 @@ class QueryParser:
 
     # Z AND A OR (B AND C) OR (D OR E)
     @classmethod
-    def parse(cls, query_string: str, use_sh: bool = False):
+    def parse(cls, query_string: str, use_sh: bool = False, canonical: bool = False):
+        """
+        Parse query_string into a Query. With canonical=True, the Query is in canonical form (see
+        Query.canonicalize), with its common sub queries shared
+        """
         tokens = cls.tokenize(query_string)
         # if use_sh:
         #     return cls._parse_sh(tokens)
+        if canonical:
+            return cls._parse(tokens).canonicalize({})
         return cls._parse(tokens)
 
     @classmethod
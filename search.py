@@ -1,24 +1,203 @@
 #!/usr/bin/python3
+import contextlib
 import re
 import string
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import nltk
 import sys
 import getopt
 
-from inverted_index import InvertedIndex
+from inverted_index import InvertedIndex, InvertedIndexRange
 from query import QueryParser
+import vectorized
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results"
+          " [-e python|numpy] [-c posting-list-cache-bytes] [-r result-cache-bytes] [-j workers | -R doc-id-ranges | -S]")
+
+# Default memory budgets of the decoded posting list cache and of the query result cache
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_BYTES = 16 * 1024 * 1024
+# With -j, the queries file is split into this many chunks of consecutive queries per worker, so that workers which
+# finish their chunks early pick up the remaining ones
+CHUNKS_PER_WORKER = 4
 
 use_sh = False
-def run_search(dict_file, postings_file, queries_file, results_file):
+
+
+def answer_query(inverted_index_class, query):
+    """
+    Evaluate one line of a queries file.
+    Returns a tuple of (the parsed Query, or None if the line is empty, line of results in the output file format)
+    """
+    query = query.strip()
+    if query == "":
+        return None, "\n"
+    query = QueryParser.parse(query, use_sh, canonical=True)
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    return query, " ".join([str(i) for i in posting_list]) + "\n"
+
+
+def stream_query(inverted_index_class, query, fw):
+    """
+    Evaluate one line of a queries file with the pull model (Query.evaluate_iter), writing every doc id to fw as soon
+    as it is produced, so that no list of results is built.
+    Returns a tuple of (the parsed Query, or None if the line is empty, number of results)
+    """
+    query = query.strip()
+    if query == "":
+        fw.write("\n")
+        return None, 0
+    query = QueryParser.parse(query, use_sh, canonical=True)
+    n = 0
+    for doc_id in query.evaluate_iter(inverted_index_class):
+        fw.write(" " + str(doc_id) if n > 0 else str(doc_id))
+        n += 1
+    fw.write("\n")
+    return query, n
+
+
+def describe_query(inverted_index_class, query):
+    return "{} --> {} results".format(query, query.get_size(inverted_index_class))
+
+
+# InvertedIndex of a worker process, set by init_worker
+worker_index = None
+
+
+def init_worker(dict_file, postings_file, engine, cache_bytes, result_cache_bytes):
+    """
+    Load the index in a worker process. The dictionary is the memory mapped snapshot and posting.txt is memory
+    mapped as well, so the workers share their pages in the page cache
+    """
+    global worker_index
+    # stdout of the parent may be used for answers (see async_search_server.py)
+    with contextlib.redirect_stdout(sys.stderr):
+        worker_index = InvertedIndex(out_dict=dict_file, out_postings=postings_file, engine=engine,
+                                     cache_bytes=cache_bytes, result_cache_bytes=result_cache_bytes)
+
+
+def answer_in_worker(query):
+    return answer_query(worker_index, query)[1]
+
+
+def answer_chunk_in_worker(queries):
+    """
+    Evaluate consecutive lines of a queries file in a worker process.
+    Returns a tuple of (lines of results, description of every non empty query)
+    """
+    results = []
+    descriptions = []
+    for query in queries:
+        query, result = answer_query(worker_index, query)
+        results.append(result)
+        if query is not None:
+            descriptions.append(describe_query(worker_index, query))
+    return results, descriptions
+
+
+def evaluate_range_in_worker(query, start, end):
+    """
+    Evaluate a parsed Query over the doc ids start <= doc id < end in a worker process.
+    Returns the sorted list of matching doc ids within the range
+    """
+    return query.evaluate(InvertedIndexRange(worker_index, start, end), forced=True)
+
+
+def share_snapshot(dict_file, postings_file):
+    """
+    Write the dictionary snapshot if it is missing or older than dict_file, so that the workers all map it rather
+    than each parsing dict_file
+    """
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    if not inverted_index_class.is_snapshot_up_to_date():
+        try:
+            inverted_index_class.save_snapshot()
+        except OSError:
+            # The workers parse dict_file instead
+            print("Dictionary snapshot could not be written")
+    inverted_index_class.close()
+
+
+def run_search_in_parallel(dict_file, postings_file, queries_file, results_file, num_workers, engine,
+                           cache_bytes, result_cache_bytes):
+    """
+    Split the queries file into chunks of consecutive queries evaluated by num_workers processes. Chunks are
+    collected in the order of the queries file, so the results file is the same as with a single process.
+    The caches are per worker, so their statistics are not reported.
+    """
+    share_snapshot(dict_file, postings_file)
+
+    with open(queries_file, 'r') as f:
+        queries = f.readlines()
+    chunk_size = max(1, -(-len(queries) // (num_workers * CHUNKS_PER_WORKER)))
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+
+    start_time = time.perf_counter()
+    n = 0
+    with ProcessPoolExecutor(num_workers, initializer=init_worker,
+                             initargs=(dict_file, postings_file, engine, cache_bytes, result_cache_bytes)) as pool:
+        with open(results_file, 'w') as fw:
+            for results, descriptions in pool.map(answer_chunk_in_worker, chunks):
+                fw.writelines(results)
+                if len(descriptions) > 0:
+                    print("\n".join(["Query #{}: {}".format(n + i + 1, description)
+                                     for i, description in enumerate(descriptions)]))
+                n += len(descriptions)
+
+    print("{} queries completed in {:.2f}s with {} workers".format(n, time.perf_counter() - start_time,
+                                                                   num_workers))
+
+
+def run_search_in_ranges(dict_file, postings_file, queries_file, results_file, num_ranges, engine,
+                         cache_bytes, result_cache_bytes):
+    """
+    Evaluate every query over num_ranges contiguous ranges of doc ids at once, one worker process per range, so that
+    a single heavy query uses every core. Each worker seeks the posting lists to the start of its range (see
+    InvertedIndexRange), and the sorted results of the ranges are concatenated in order.
+    Queries are parsed once, and sent to the workers as Query objects.
+    """
+    share_snapshot(dict_file, postings_file)
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    doc_ranges = inverted_index_class.get_doc_ranges(num_ranges)
+
+    start_time = time.perf_counter()
+    n = 0
+    with ProcessPoolExecutor(len(doc_ranges), initializer=init_worker,
+                             initargs=(dict_file, postings_file, engine, cache_bytes, result_cache_bytes)) as pool:
+        with open(queries_file, 'r') as f:
+            with open(results_file, 'w') as fw:
+                for query in f:
+                    query = query.strip()
+                    if query == "":
+                        fw.write("\n")
+                        continue
+                    query = QueryParser.parse(query, use_sh, canonical=True)
+                    futures = [pool.submit(evaluate_range_in_worker, query, start, end) for start, end in doc_ranges]
+                    posting_list = []
+                    for future in futures:
+                        posting_list += future.result()
+                    fw.write(" ".join([str(i) for i in posting_list]) + "\n")
+                    n += 1
+                    print("Query #{}: {} --> {} results".format(n, query, len(posting_list)))
+
+    inverted_index_class.close()
+    print("{} queries completed in {:.2f}s over {} doc id ranges".format(n, time.perf_counter() - start_time,
+                                                                         len(doc_ranges)))
+
+
+def run_search(dict_file, postings_file, queries_file, results_file, engine="python",
+               cache_bytes=POSTINGS_CACHE_BYTES, result_cache_bytes=RESULT_CACHE_BYTES, num_workers=1, num_ranges=1,
+               stream=False):
     """
     using the given dictionary file and postings file,
-    perform searching on the given queries file and output the results to a file
+    perform searching on the given queries file and output the results to a file.
+    With num_workers > 1, the queries are evaluated by that many processes.
+    With num_ranges > 1, every query is evaluated over that many ranges of doc ids in parallel.
+    With stream, the results are written as they are produced by the pull model (see stream_query)
     """
     """
     single query search
@@ -30,13 +209,24 @@ def run_search(dict_file, postings_file, queries_file, results_file):
 
     print('running search on the queries...')
 
+    if num_ranges > 1:
+        run_search_in_ranges(dict_file, postings_file, queries_file, results_file, num_ranges, engine,
+                             cache_bytes, result_cache_bytes)
+        return
+
+    if num_workers > 1:
+        run_search_in_parallel(dict_file, postings_file, queries_file, results_file, num_workers, engine,
+                               cache_bytes, result_cache_bytes)
+        return
+
     # This is an empty method
     # Pls implement your code in below
 
 
     ############################################
 
-    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file)
+    inverted_index_class = InvertedIndex(out_dict=dict_file, out_postings=postings_file, engine=engine,
+                                         cache_bytes=cache_bytes, result_cache_bytes=result_cache_bytes)
 
     start_time = time.perf_counter()
     n = 0
@@ -44,45 +234,78 @@ def run_search(dict_file, postings_file, queries_file, results_file):
     with open(queries_file, 'r') as f:
         with open(results_file, 'w') as fw:
             for query in f:
-                query = query.strip()
-                if query == "":
-                    out.append("\n")
+                if stream:
+                    query, size = stream_query(inverted_index_class, query, fw)
+                    if query is not None:
+                        n += 1
+                        print("Query #{}: {} --> {} results".format(n, query, size))
+                    continue
+                query, result = answer_query(inverted_index_class, query)
+                out.append(result)
+                if query is None:
                     continue
                 n += 1
-                query = QueryParser.parse(query, use_sh)
                 # print(query.__str__())
-                posting_list = query.evaluate(inverted_index_class, forced=True)
-                print("Query #{}: {} --> {} results".format(n, query, len(posting_list)))
-
-                out.append(" ".join([str(i) for i in posting_list]) + "\n")
-                # fw.write(" ".join([str(i) for i in posting_list]) + "\n")
+                print("Query #{}: {}".format(n, describe_query(inverted_index_class, query)))
 
             fw.writelines(out)
 
+    print("Posting list cache: " + inverted_index_class.postings_cache.get_stats())
+    print("Result cache: " + inverted_index_class.result_cache.get_stats())
+    inverted_index_class.close()
     print("{} queries completed in {:.2f}s".format(n, time.perf_counter() - start_time))
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-d':
-        dictionary_file  = a
-    elif o == '-p':
-        postings_file = a
-    elif o == '-q':
-        file_of_queries = a
-    elif o == '-o':
-        file_of_output = a
-    else:
-        assert False, "unhandled option"
-
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None :
-    usage()
-    sys.exit(2)
-
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
\ No newline at end of file
+if __name__ == '__main__':
+    dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+    engine = "python"
+    cache_bytes = POSTINGS_CACHE_BYTES
+    result_cache_bytes = RESULT_CACHE_BYTES
+    num_workers = 1
+    num_ranges = 1
+    stream = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:e:c:r:j:R:S')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file  = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-e':
+            engine = a
+        elif o == '-c':
+            cache_bytes = int(a)
+        elif o == '-r':
+            result_cache_bytes = int(a)
+        elif o == '-j':
+            num_workers = int(a)
+        elif o == '-R':
+            num_ranges = int(a)
+        elif o == '-S':
+            stream = True
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None :
+        usage()
+        sys.exit(2)
+
+    if engine not in ["python", "numpy"] or num_workers < 1 or num_ranges < 1 or \
+            len([mode for mode in [num_workers > 1, num_ranges > 1, stream] if mode]) > 1:
+        usage()
+        sys.exit(2)
+
+    if engine == "numpy" and vectorized.np is None:
+        print("numpy is not installed, use -e python")
+        sys.exit(2)
+
+    run_search(dictionary_file, postings_file, file_of_queries, file_of_output, engine, cache_bytes, result_cache_bytes,
+               num_workers, num_ranges, stream)
\ No newline at end of file
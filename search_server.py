@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+import contextlib
+import getopt
+import io
+import os
+import socketserver
+import sys
+import time
+
+import vectorized
+from inverted_index import InvertedIndex
+from search import answer_query, POSTINGS_CACHE_BYTES, RESULT_CACHE_BYTES
+
+"""
+    Long running search server. The index is loaded once, and the posting list and result caches stay warm across
+    queries and connections.
+    Queries are read one per line, from stdin by default, or from the connections to a local socket: a unix domain
+    socket with -s, or a TCP port on localhost with -t. Every query is answered with one line in the output file
+    format of search.py. Lines starting with ! are commands:
+        !batch n    The n following lines are queries. They are evaluated together and their n result lines are
+                    written at once, so that a client can pipeline thousands of queries in a single round trip.
+        !stats      Answers with one line of cache statistics.
+        !quit       Closes the connection (or stops reading stdin).
+        !shutdown   Stops the server.
+    A query or command that can not be answered, such as a malformed query, is answered with `!error <message>`, as
+    in async_search_server.py, and the server goes on with the next line.
+    Connections are served one at a time, as the caches of the index are not shared safely between threads.
+"""
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file [-s socket-file | -t port]"
+          " [-e python|numpy] [-c posting-list-cache-bytes] [-r result-cache-bytes]")
+
+
+class SearchServer:
+    def __init__(self, inverted_index_class):
+        self.inverted_index_class = inverted_index_class
+        self.num_queries = 0
+        self.num_errors = 0
+        self.is_shut_down = False
+
+    def answer(self, query):
+        self.num_queries += 1
+        try:
+            return answer_query(self.inverted_index_class, query)[1]
+        except Exception as e:
+            return self.error(e)
+
+    def error(self, e):
+        self.num_errors += 1
+        return "!error {}\n".format(str(e).replace("\n", " "))
+
+    def get_stats(self):
+        return "{} queries, {} errors, posting list cache: {}, result cache: {}\n".format(
+            self.num_queries, self.num_errors, self.inverted_index_class.postings_cache.get_stats(),
+            self.inverted_index_class.result_cache.get_stats())
+
+    def serve(self, reader, writer):
+        """
+            Answers the lines of the text stream reader on the text stream writer, until the end of reader,
+            !quit or !shutdown
+        """
+        for line in reader:
+            command = line.strip()
+            if command.startswith("!batch"):
+                fields = command.split()
+                if len(fields) != 2 or not fields[1].isdigit():
+                    # The lines that follow are then answered one at a time
+                    writer.write(self.error("invalid batch size: {}".format(command)))
+                else:
+                    queries = [reader.readline() for _ in range(int(fields[1]))]
+                    writer.write("".join([self.answer(query) for query in queries]))
+            elif command == "!stats":
+                writer.write(self.get_stats())
+            elif command == "!quit":
+                break
+            elif command == "!shutdown":
+                self.is_shut_down = True
+                break
+            else:
+                writer.write(self.answer(line))
+            writer.flush()
+
+
+def serve_stdin(search_server):
+    search_server.serve(sys.stdin, sys.stdout)
+
+
+def serve_socket(search_server, server_class, address):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            writer = io.TextIOWrapper(self.wfile, encoding="utf-8")
+            search_server.serve(io.TextIOWrapper(self.rfile, encoding="utf-8"), writer)
+            writer.flush()
+
+    with server_class(address, Handler) as server:
+        print("Serving on {}".format(address), file=sys.stderr)
+        while not search_server.is_shut_down:
+            server.handle_request()
+
+
+if __name__ == '__main__':
+    dictionary_file = postings_file = socket_file = port = None
+    engine = "python"
+    cache_bytes = POSTINGS_CACHE_BYTES
+    result_cache_bytes = RESULT_CACHE_BYTES
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:s:t:e:c:r:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-s':
+            socket_file = a
+        elif o == '-t':
+            port = int(a)
+        elif o == '-e':
+            engine = a
+        elif o == '-c':
+            cache_bytes = int(a)
+        elif o == '-r':
+            result_cache_bytes = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None or (socket_file != None and port != None):
+        usage()
+        sys.exit(2)
+
+    if engine not in ["python", "numpy"] or (engine == "numpy" and vectorized.np is None):
+        usage()
+        sys.exit(2)
+
+    start_time = time.perf_counter()
+    # stdout may be the channel queries are answered on, so progress messages go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        inverted_index_class = InvertedIndex(out_dict=dictionary_file, out_postings=postings_file, engine=engine,
+                                             cache_bytes=cache_bytes, result_cache_bytes=result_cache_bytes)
+    print("Index loaded in {:.3f}s".format(time.perf_counter() - start_time), file=sys.stderr)
+    search_server = SearchServer(inverted_index_class)
+
+    try:
+        if socket_file != None:
+            if os.path.exists(socket_file):
+                os.remove(socket_file)
+            serve_socket(search_server, socketserver.UnixStreamServer, socket_file)
+        elif port != None:
+            serve_socket(search_server, socketserver.TCPServer, ("127.0.0.1", port))
+        else:
+            serve_stdin(search_server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if socket_file != None and os.path.exists(socket_file):
+            os.remove(socket_file)
+        print(search_server.get_stats(), end="", file=sys.stderr)
+        inverted_index_class.close()
@@ -1,4 +1,6 @@
 #!/usr/bin/python3
+import io
+import random
 import re
 import string
 
@@ -6,8 +8,16 @@ import nltk
 import sys
 import getopt
 
-from inverted_index import InvertedIndex
-from query import QueryParser
+from bisect import bisect_left
+
+from cursors import ListCursor, AndCursor, OrCursor, NotCursor
+from inverted_index import InvertedIndex, InvertedIndexRange
+from postings import encode_postings, encode_containers, decode_header, decode_body, decode_containers, \
+    vb_decode_number, PostingsCursor, POSTINGS_GAPS, POSTINGS_BITMAP, SKIP_INTERVAL, CHUNK_BITS, CONTAINER_ARRAY, \
+    CONTAINER_BITMAP, get_num_skip_levels
+from query import QueryParser, QueryOr, QueryAnd, QueryNot
+from search_server import SearchServer
+import vectorized
 
 
 # Program Arguments:
@@ -155,6 +165,100 @@ def test_not_queries(inverted_index_class):
     assert posting_list == [2]
     return False
 
+class AllFilesGuard(list):
+    """
+    Stands in for all_files, failing on any read of the doc ids. Only their number can be used.
+    """
+    def __getitem__(self, index):
+        raise AssertionError("all_files read")
+
+    def __iter__(self):
+        raise AssertionError("all_files read")
+
+
+def test_lazy_not_queries(inverted_index_class):
+    # NOT is only evaluated against all doc ids for a negated top-level result
+    all_files = inverted_index_class.all_files
+    inverted_index_class.all_files = AllFilesGuard(all_files)
+
+    query = QueryParser.parse("NOT s AND NOT a AND y")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == [2]
+
+    query = QueryParser.parse("y AND (NOT a OR NOT b)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == [1, 2]
+
+    # Negated top-level result, returned without its complement
+    query = QueryParser.parse("(NOT a OR NOT b) AND (NOT z OR y)")
+    posting_list = query.evaluate(inverted_index_class, forced=False)
+    assert posting_list == [0]
+
+    inverted_index_class.all_files = all_files
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == [1, 2, 3]
+
+    query = QueryParser.parse("NOT a OR z")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == [0, 1, 2, 3]
+
+    query = QueryParser.parse("NOT (NOT a OR b)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert len(posting_list) == 0
+
+
+def test_plan_queries(inverted_index_class):
+    # Union bound
+    query = QueryParser.parse("a OR z")
+    query.plan(inverted_index_class)
+    assert query.estimated_size == 4
+
+    # Independence of operands, out of 4 docs
+    query = QueryParser.parse("x AND y")
+    query.plan(inverted_index_class)
+    assert query.estimated_size == 4 * (3 / 4) * (3 / 4)
+
+    query = QueryParser.parse("NOT z")
+    query.plan(inverted_index_class)
+    assert query.estimated_size == 1
+
+    # Provably empty queries are not evaluated
+    query = QueryParser.parse("abc AND (x OR y)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert query.is_empty
+    assert len(posting_list) == 0
+    assert [op for op in query.ops if isinstance(op, QueryOr)][0].size is None
+
+    query = QueryParser.parse("NOT abc AND y")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert [op.__str__() for op in query.plan_ops] == ['y']
+    assert posting_list == [0, 1, 2]
+
+    # Smaller operands first
+    query = QueryParser.parse("(x AND y) AND (v AND z)")
+    query.plan(inverted_index_class)
+    assert [op.__str__() for op in query.plan_ops] == ['v', 'z', 'y', 'x']
+
+
+def test_short_circuit_queries(inverted_index_class):
+    # Operands are not evaluated once the intersection is empty
+    query = QueryParser.parse("a AND r AND (x OR y)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert len(posting_list) == 0
+    assert [op for op in query.ops if isinstance(op, QueryOr)][0].size is None
+
+    query = QueryParser.parse("a AND r AND NOT (x OR y)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert len(posting_list) == 0
+    assert [op for op in query.ops if isinstance(op, QueryNot)][0].size is None
+
+    # An OR with a negated operand matching every document
+    query = QueryParser.parse("NOT (a AND r) OR (x AND y)")
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == [0, 1, 2, 3]
+    assert [op for op in query.ops if isinstance(op, QueryAnd)][0].size is None
+
+
 def test_mix_queries(inverted_index_class):
     query = QueryParser.parse("(a OR r) AND (r AND z)")
     assert query.__str__() == 'z∧r∧r∨a'
@@ -182,6 +286,253 @@ def test_mix_queries(inverted_index_class):
     assert posting_list == [0, 3]
 
 
+def test_canonical_queries(inverted_index_class, dict_file, postings_file):
+    # Operands are sorted and repeated ones dropped
+    query = QueryParser.parse("(x AND y) AND (v AND z) AND (u AND z)", canonical=True)
+    assert query.__str__() == 'u∧v∧x∧y∧z'
+
+    query = QueryParser.parse("(a OR b) OR (r OR a) OR (b OR z)", canonical=True)
+    assert query.__str__() == 'a∨b∨r∨z'
+
+    query = QueryParser.parse("z AND NOT (NOT bb)", canonical=True)
+    assert query.__str__() == 'bb∧z'
+
+    query = QueryParser.parse("(a OR a) AND (a OR a)", canonical=True)
+    assert query.__str__() == 'a'
+
+    assert QueryParser.parse("(y AND NOT z) AND NOT (a OR r)", canonical=True).key == \
+        QueryParser.parse("NOT (r OR a) AND NOT z AND y", canonical=True).key
+
+    # Common sub queries are shared, and evaluated once
+    query_string = "(a OR r) AND z OR (r OR a) AND y"
+    query = QueryParser.parse(query_string, canonical=True)
+    shared = [[op for op in and_op.ops if isinstance(op, QueryOr)][0] for and_op in query.ops]
+    assert shared[0] is shared[1]
+    expected = QueryParser.parse(query_string).evaluate(inverted_index_class, forced=True)
+    posting_list = query.evaluate(inverted_index_class, forced=True)
+    assert posting_list == expected
+
+    # Results of repeated queries are taken from the result cache. The first evaluation looks up the root, both
+    # ANDs and the shared OR once
+    inverted_index_cached = InvertedIndex("", dict_file, postings_file, result_cache_bytes=1024 * 1024)
+    for i in range(2):
+        posting_list = QueryParser.parse("(r OR a) AND y OR z AND (a OR r)", canonical=True).evaluate(
+            inverted_index_cached, forced=True)
+        assert posting_list == expected
+    assert inverted_index_cached.result_cache.misses == 4
+    assert inverted_index_cached.result_cache.hits == 1
+
+
+def test_numpy_engine(inverted_index_class, inverted_index_numpy):
+    # The numpy engine returns the same documents as the python one
+    for query_string in ["a", "a AND b", "a OR r OR x", "NOT a", "NOT a AND NOT b", "a OR NOT b",
+                         "(a OR r) AND (r AND z)", "(a AND r) OR (p AND q) OR (n AND x)", "NOT (a AND r) OR (x AND y)",
+                         "aa AND dd AND ee OR b", "a AND missing", "NOT missing"]:
+        expected = QueryParser.parse(query_string).evaluate(inverted_index_class, forced=True)
+        posting_list = QueryParser.parse(query_string).evaluate(inverted_index_numpy, forced=True)
+        assert posting_list == expected
+
+
+def test_postings_cache(inverted_index_class, dict_file, postings_file):
+    inverted_index_cached = InvertedIndex("", dict_file, postings_file, cache_bytes=1024 * 1024)
+    query_string = "(z AND u) AND (z AND v) AND (y AND x)"
+    expected = QueryParser.parse(query_string).evaluate(inverted_index_class, forced=True)
+
+    # A term repeated within a query is decoded once
+    posting_list = QueryParser.parse(query_string).evaluate(inverted_index_cached, forced=True)
+    assert posting_list == expected
+    assert inverted_index_cached.postings_cache.hits == 1
+
+    # and so is every term of a repeated query
+    posting_list = QueryParser.parse(query_string).evaluate(inverted_index_cached, forced=True)
+    assert posting_list == expected
+    assert inverted_index_cached.postings_cache.hits == 7
+
+    # Least recently used posting lists are evicted once the budget is exceeded
+    cache = inverted_index_cached.postings_cache
+    cache.clear()
+    inverted_index_cached.get_postings_for_term("a")
+    cache.max_bytes = cache.num_bytes * 2
+    inverted_index_cached.get_postings_for_term("b")
+    inverted_index_cached.get_postings_for_term("a")
+    inverted_index_cached.get_postings_for_term("r")
+    assert "a" in cache and "r" in cache and "b" not in cache
+    assert cache.num_bytes <= cache.max_bytes
+
+    # Posting lists read through a cursor are not cached, so they only count as hits if they were decoded before
+    inverted_index_cached = InvertedIndex("", dict_file, postings_file, cache_bytes=1024 * 1024)
+    cache = inverted_index_cached.postings_cache
+    inverted_index_cached.get_cursor_for_term("a")
+    inverted_index_cached.get_cursor_for_term("a")
+    assert cache.hits == 0 and cache.misses == 0
+    inverted_index_cached.get_postings_for_term("a")
+    inverted_index_cached.get_cursor_for_term("a")
+    assert cache.hits == 1 and cache.misses == 1
+
+    # A disabled cache counts nothing
+    inverted_index_uncached = InvertedIndex("", dict_file, postings_file, cache_bytes=0)
+    QueryParser.parse(query_string).evaluate(inverted_index_uncached, forced=True)
+    list(QueryParser.parse(query_string).evaluate_iter(inverted_index_uncached))
+    cache = inverted_index_uncached.postings_cache
+    assert cache.hits == 0 and cache.misses == 0 and len(cache) == 0
+
+
+def test_doc_ranges(inverted_index_class):
+    # The ranges cover every doc id once, in order
+    doc_ranges = inverted_index_class.get_doc_ranges(3)
+    assert len(doc_ranges) == 3
+    assert [doc_range[0] for doc_range in doc_ranges[1:]] == [doc_range[1] for doc_range in doc_ranges[:-1]]
+    assert sum([len(InvertedIndexRange(inverted_index_class, start, end).all_files) for start, end in doc_ranges]) \
+        == len(inverted_index_class.all_files)
+
+    # Concatenating the results of every range gives the result of the whole query, NOT included
+    for query_string in ["a", "a AND b", "a OR r OR x", "NOT a", "NOT a AND NOT b", "a OR NOT b",
+                         "(a AND r) OR (p AND q) OR (n AND x)", "NOT (a AND r) OR (x AND y)", "a AND missing",
+                         "NOT missing"]:
+        expected = QueryParser.parse(query_string).evaluate(inverted_index_class, forced=True)
+        for num_ranges in [1, 2, 3, len(inverted_index_class.all_files) + 1]:
+            posting_list = []
+            for start, end in inverted_index_class.get_doc_ranges(num_ranges):
+                posting_list += QueryParser.parse(query_string, canonical=True).evaluate(
+                    InvertedIndexRange(inverted_index_class, start, end), forced=True)
+            assert posting_list == expected
+
+
+def test_stream_queries(inverted_index_class):
+    # Cursors skip ahead with advance, and stay at their current doc id if it is not before the target
+    cursor = AndCursor([ListCursor([1, 3, 5, 7, 9]), OrCursor([ListCursor([3, 4]), ListCursor([7, 9])])],
+                       [NotCursor(ListCursor([3, 4, 5, 9]), ListCursor([1, 2, 3, 4, 5, 6, 7, 8, 9]))])
+    assert cursor.next() == 3
+    assert cursor.advance(2) == 3
+    assert cursor.advance(4) == 9
+    assert cursor.next() is None
+
+    # Streamed results are the same as the evaluated ones
+    for query_string in ["a", "a AND b", "a OR r OR x", "NOT a", "NOT a AND NOT b", "a OR NOT b",
+                         "(a OR r) AND (r AND z)", "(a AND r) OR (p AND q) OR (n AND x)", "NOT (a AND r) OR (x AND y)",
+                         "aa AND dd AND ee OR b", "a AND NOT (b OR NOT c)", "a AND missing", "NOT missing",
+                         "missing OR NOT a"]:
+        expected = QueryParser.parse(query_string).evaluate(inverted_index_class, forced=True)
+        for canonical in [False, True]:
+            query = QueryParser.parse(query_string, canonical=canonical)
+            assert list(query.evaluate_iter(inverted_index_class)) == expected
+
+
+def test_postings_skips():
+    # Sparse lists, which stay gap encoded, with 1 to 3 levels of skips
+    for size, num_levels in [(17, 1), (257, 2), (5000, 3)]:
+        rng = random.Random(size)
+        doc_ids = []
+        doc_id = 0
+        for _ in range(size):
+            doc_id += rng.randint(1, 300)
+            doc_ids.append(doc_id)
+        assert get_num_skip_levels(size) == num_levels
+
+        buf = memoryview(encode_postings(doc_ids))
+        num_doc_ids, kind, body_len, body_pos = decode_header(buf)
+        assert num_doc_ids == size and kind == POSTINGS_GAPS
+        assert decode_body(buf, body_pos, body_pos + body_len) == doc_ids
+        assert PostingsCursor(buf).to_list() == doc_ids
+
+        # Targets before, on, between and past the doc ids, in particular those of the skip entries
+        targets = [0, doc_ids[0], doc_ids[-1], doc_ids[-1] + 1]
+        for stride in [SKIP_INTERVAL ** (level + 1) for level in range(num_levels)]:
+            for doc_id in doc_ids[stride::stride]:
+                targets += [doc_id - 1, doc_id, doc_id + 1]
+        targets += [rng.randint(0, doc_ids[-1]) for _ in range(100)]
+
+        def first_from(target):
+            i = bisect_left(doc_ids, target)
+            return doc_ids[i] if i < size else None
+
+        # From the start of the list
+        for target in targets:
+            assert PostingsCursor(buf).advance(target) == first_from(target)
+
+        # From wherever the previous target left the cursor, mixed with next()
+        cursor = PostingsCursor(buf)
+        i = 0  # Index of the current doc id
+        for target in sorted(set(targets)):
+            # Targets not past the current doc id leave the cursor where it is
+            i = max(i, bisect_left(doc_ids, target))
+            assert cursor.advance(target) == (doc_ids[i] if i < size else None)
+            i += 1
+            assert cursor.next() == (doc_ids[i] if i < size else None)
+            if i >= size:
+                break
+
+        # Ranges of doc ids, as read by InvertedIndexRange
+        for start, end in [(0, doc_ids[-1] + 1), (0, doc_ids[SKIP_INTERVAL]), (doc_ids[SKIP_INTERVAL], doc_ids[-1]),
+                           (doc_ids[size // 2] + 1, doc_ids[size // 2] + 1), (doc_ids[-1] + 1, doc_ids[-1] + 10)]:
+            cursor = PostingsCursor(buf)
+            cursor.advance(start)
+            assert cursor.take_until(end) == [doc_id for doc_id in doc_ids if start <= doc_id < end]
+            assert cursor.advance(end) == first_from(end)
+
+
+def get_container_kinds(buf, start, end):
+    """
+    Returns the kind of every container in buf[start:end]
+    """
+    kinds = []
+    pos = start
+    while pos < end:
+        chunk, pos = vb_decode_number(buf, pos)
+        container_kind, pos = vb_decode_number(buf, pos)
+        payload_len, pos = vb_decode_number(buf, pos)
+        kinds.append(container_kind)
+        pos += payload_len
+    return kinds
+
+
+def test_postings_containers():
+    chunk_size = 2 ** CHUNK_BITS
+    # Lists of the given density and the kind of list and of containers they are stored as
+    every_4th = list(range(0, chunk_size, 4))
+    sparse = [chunk_size + 100, chunk_size + 5000, chunk_size + 60000]
+    for doc_ids, kind, container_kinds in [
+            (list(range(3000)), POSTINGS_BITMAP, [CONTAINER_BITMAP]),
+            (every_4th, POSTINGS_BITMAP, [CONTAINER_BITMAP]),
+            # A byte per doc id either way, so containers are arrays, but skips make the gaps bigger
+            (list(range(0, chunk_size, 8)), POSTINGS_BITMAP, [CONTAINER_ARRAY]),
+            (list(range(0, 4 * chunk_size, 16)), POSTINGS_GAPS, None),
+            # A dense chunk, a sparse one, an empty one and a full one
+            (every_4th + sparse + list(range(3 * chunk_size, 4 * chunk_size)), POSTINGS_BITMAP,
+             [CONTAINER_BITMAP, CONTAINER_ARRAY, CONTAINER_BITMAP])]:
+        buf = memoryview(encode_postings(doc_ids))
+        num_doc_ids, list_kind, body_len, body_pos = decode_header(buf)
+        assert num_doc_ids == len(doc_ids) and list_kind == kind
+        if kind == POSTINGS_BITMAP:
+            assert get_container_kinds(buf, body_pos, body_pos + body_len) == container_kinds
+            bitmap = decode_containers(buf, body_pos, body_pos + body_len)
+            assert bitmap.to_list() == doc_ids and len(bitmap) == len(doc_ids)
+        else:
+            assert decode_body(buf, body_pos, body_pos + body_len) == doc_ids
+
+    # Containers of any list round trip, whether or not the list would be stored as a bitmap
+    for doc_ids in [[0], sparse, [5, chunk_size - 1, chunk_size, 10 * chunk_size + 7], every_4th + sparse]:
+        containers = encode_containers(doc_ids)
+        assert decode_containers(containers, 0, len(containers)).to_list() == doc_ids
+
+
+def test_search_server(inverted_index_class):
+    # A line which can not be answered is answered with !error, and the queries after it on the same connection
+    # are still answered
+    search_server = SearchServer(inverted_index_class)
+    reader = io.StringIO("a AND b\nbank AND\na AND (b\n!batch x\na\n!batch 2\na AND\nb\n!quit\na\n")
+    writer = io.StringIO()
+    search_server.serve(reader, writer)
+    lines = writer.getvalue().splitlines()
+    assert len(lines) == 7
+    assert lines[0] == "0"
+    assert lines[1].startswith("!error ") and lines[2].startswith("!error ") and lines[3].startswith("!error ")
+    assert lines[4] == "0"
+    assert lines[5].startswith("!error ")
+    assert lines[6] == " ".join([str(i) for i in QueryParser.parse("b").evaluate(inverted_index_class, forced=True)])
+    assert search_server.num_errors == 4 and not search_server.is_shut_down
+
+
 def run_test(dict_file, postings_file):
     """
     using the given dictionary file and postings file,
@@ -204,8 +555,31 @@ def run_test(dict_file, postings_file):
 
     test_not_queries(inverted_index_class_done)
 
+    test_lazy_not_queries(inverted_index_class_done)
+
+    test_plan_queries(inverted_index_class_done)
+
+    test_short_circuit_queries(inverted_index_class_done)
+
     test_mix_queries(inverted_index_class_done)
 
+    test_postings_cache(inverted_index_class_done, dict_file, postings_file)
+
+    test_canonical_queries(inverted_index_class_done, dict_file, postings_file)
+
+    test_doc_ranges(inverted_index_class_done)
+
+    test_stream_queries(inverted_index_class_done)
+
+    test_search_server(inverted_index_class_done)
+
+    test_postings_skips()
+
+    test_postings_containers()
+
+    if vectorized.np is not None:
+        test_numpy_engine(inverted_index_class_done, InvertedIndex("", dict_file, postings_file, engine="numpy"))
+
     # Maybe can test for invalid queries
 
 
@@ -0,0 +1,93 @@
+import re
+import string
+
+from nltk.tokenize import word_tokenize
+from nltk.tokenize import sent_tokenize
+
+"""
+    Tokenizers used by InvertedIndex.read_terms. Each takes a line of a document and returns its words,
+    case folded and with punctuations removed. Words may be empty strings, which are dropped by read_terms.
+
+    nltk: nltk.sent_tokenize() followed by nltk.word_tokenize() on every sentence.
+    regex: Reproduces the words produced by the nltk tokenizer with a few compiled regular expressions per line.
+        nltk's word tokenizer pads punctuations with spaces and splits on whitespace. As punctuations are removed
+        afterwards, the only padding that changes the resulting words is the one that splits two runs of
+        letters/digits apart. These are the rules kept here, in the order nltk applies them:
+        - punctuations which are always split off, such as brackets, quotes, ;@#$%&?!*, `...` and `--`
+        - commas and colons not followed by a digit, eg. "a,b" but not "1,000"
+        - clitics at the end of a word, eg. "company's" -> "company 's" and "don't" -> "do n't"
+        - contractions eg. "cannot" -> "can not"
+        nltk only splits clitics off when they are followed by a space. Sentence tokenization matters only there,
+        as the final period of a sentence is padded. A period followed by whitespace or the end of the line
+        is taken to end a sentence, so this is decided on the line before any space is inserted.
+"""
+
+translator = str.maketrans('', '', string.punctuation)
+
+# Spaces inserted around quotes and clitics are marked with \0 instead, so that a period before them is not mistaken
+# for the end of a sentence. They are turned into spaces when punctuations are removed.
+_SPLIT_MARK = "\0"
+_regex_translator = str.maketrans({_SPLIT_MARK: " ", **{c: None for c in string.punctuation}})
+
+# Quotes and dashes padded by nltk that are not in string.punctuation, and hence are kept as words of their own
+_KEPT_PADDED = re.compile("[«“‘„»”’\u2012-\u2015]")
+
+# Opening single quotes, which nltk splits off before anything else
+_OPENING_QUOTE = re.compile(r"(?<!\w)'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)", re.IGNORECASE)
+
+# Punctuations padded by nltk. They are removed afterwards, so they are simply replaced by a space
+_SPLIT = re.compile("|".join([
+    r"[`\"\[\](){}<>;@#$%&?!*]",
+    r"''",
+    r"\.{2,}",
+    r"--",
+    r"[:,](?!\d)",
+]))
+
+# nltk splits clitics off only if they are followed by a space once punctuations have been padded. This is the case
+# if they are followed by whitespace, a padded punctuation, the final period of a sentence, or a closing quote
+# followed by one of the punctuations padded before closing quotes are.
+_FOLLOWED_BY_SPACE = (r"(?=[\s\0]|$|'(?:[\s\0]|[`;@#$%&?!«“‘„\u2012-\u2015]|\.{2,}|[:,](?!\d))"
+                      r"|[`\"\[\](){}<>;@#$%&?!*«“‘„»”’\u2012-\u2015]|''|\.{2,}|--|[:,](?!\d)"
+                      r"|\.[\]\)}>\"']*(?:\s|$))")
+_CLITIC_1 = re.compile(r"(?<=[^'\s\0])('[sSmMdD]|')" + _FOLLOWED_BY_SPACE)
+_CLITIC_2 = re.compile(r"(?<=[^'\s\0])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T)" + _FOLLOWED_BY_SPACE)
+
+# The lookahead on the first letter lets most words be skipped without trying every contraction
+_CONTRACTION = re.compile(
+    r"\b(?=[cdglmw])(?:(can)(not)\b|(d)('ye)\b|(gim)(me)\b|(gon)(na)\b|(got)(ta)\b|(lem)(me)\b|(more)('n)\b"
+    r"|(wan)(na)(?=[\s\0]|$))|(?:(?<=[\s\0])|^)('t)(is|was)\b", re.IGNORECASE)
+
+
+def nltk_tokenize(line):
+    words = []
+    # Tokenize by sentences
+    for s_token in sent_tokenize(line):
+        # Tokenize by word
+        for w_token in word_tokenize(s_token):
+            # Remove Punctuation & Case-Folding
+            words.append(w_token.translate(translator).lower())
+    return words
+
+
+def _split_contraction(match):
+    return " " + " ".join([part for part in match.groups() if part is not None]) + " "
+
+
+def regex_tokenize(line):
+    if "'" in line:
+        line = _OPENING_QUOTE.sub("'" + _SPLIT_MARK, line)
+        line = _CLITIC_1.sub(_SPLIT_MARK + r"\1", line)
+        line = _CLITIC_2.sub(_SPLIT_MARK + r"\1", line)
+    if not line.isascii():
+        line = _KEPT_PADDED.sub(r" \g<0> ", line)
+    line = _SPLIT.sub(" ", line)
+    line = _CONTRACTION.sub(_split_contraction, line)
+    # Remove Punctuation & Case-Folding
+    return line.translate(_regex_translator).lower().split()
+
+
+TOKENIZERS = {
+    "nltk": nltk_tokenize,
+    "regex": regex_tokenize,
+}
@@ -0,0 +1,104 @@
+"""
+    Vectorized counterparts of the posting list operations of query.py, used when searching with -e numpy.
+    Posting lists are numpy int32 arrays decoded straight from the memory mapped posting.txt, and intersection,
+    union and difference run over whole arrays within numpy. The list based operations of query.py stay the
+    reference implementation, and query.py hands any operation involving an array over to this module.
+
+    numpy is optional: without it, np is None and only the python engine is available.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from postings import decode_header, decode_body, decode_containers, POSTINGS_BITMAP
+
+# Bodies shorter than this are decoded by decode_body, as the fixed cost of every numpy call outweighs the gain
+VECTORIZE_MIN_BYTES = 256
+
+
+def is_array(docs):
+    return np is not None and isinstance(docs, np.ndarray)
+
+
+def as_array(docs):
+    """
+        Returns docs as an int32 array. docs is an array or a list of doc ids, such as the empty list returned for
+        queries pruned by the planning pass
+    """
+    if is_array(docs):
+        return docs
+    return np.array(docs, dtype=np.int32)
+
+
+def decode_body_array(buf, start, end):
+    """
+        Decodes the gap encoded body in buf[start:end] into an int32 array of doc ids.
+        Every byte is shifted by 7 bits per byte that follows it within its number, the bytes of every number are
+        summed with np.add.reduceat, and the gaps are summed up with np.cumsum.
+    """
+    if end - start < VECTORIZE_MIN_BYTES:
+        return np.array(decode_body(buf, start, end), dtype=np.int32)
+    data = np.frombuffer(buf[start:end], dtype=np.uint8)
+    # Position of the last byte of every number, and of the number every byte belongs to
+    last = np.flatnonzero(data >= 128)
+    first = np.concatenate(([0], last[:-1] + 1))
+    number = np.repeat(np.arange(len(last)), last - first + 1)
+    shifts = 7 * (last[number] - np.arange(len(data)))
+    gaps = np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, first)
+    return np.cumsum(gaps).astype(np.int32)
+
+
+def bitmap_to_array(bitmap):
+    data = np.frombuffer(bitmap.bits.to_bytes((bitmap.bits.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder='little')).astype(np.int32)
+
+
+def decode_postings_array(buf, pos):
+    """
+        Decodes the posting list at pos in buf into an int32 array, whatever its kind
+    """
+    size, kind, body_len, body_pos = decode_header(buf, pos)
+    if kind == POSTINGS_BITMAP:
+        return bitmap_to_array(decode_containers(buf, body_pos, body_pos + body_len))
+    return decode_body_array(buf, body_pos, body_pos + body_len)
+
+
+def contains(large, small):
+    """
+        Boolean mask of the doc ids of small that are in large, found with a binary search of every doc id of small
+        in large (np.searchsorted)
+    """
+    if len(large) == 0:
+        return np.zeros(len(small), dtype=bool)
+    positions = np.searchsorted(large, small)
+    positions[positions == len(large)] = 0
+    return large[positions] == small
+
+
+def intersect(l1, l2):
+    l1 = as_array(l1)
+    l2 = as_array(l2)
+    if len(l1) > len(l2):
+        l1, l2 = l2, l1
+    return l1[contains(l2, l1)]
+
+
+def union(lists):
+    """
+        Union of any number of arrays or lists of doc ids, by sorting them together and dropping every doc id equal
+        to the one before it. This is what np.union1d does, but np.unique, which it relies on, is slower than
+        sorting on arrays of this size.
+    """
+    if len(lists) == 1:
+        return as_array(lists[0])
+    docs = np.sort(np.concatenate([as_array(l) for l in lists]))
+    keep = np.empty(len(docs), dtype=bool)
+    keep[0] = True
+    np.not_equal(docs[1:], docs[:-1], out=keep[1:])
+    return docs[keep]
+
+
+def difference(l1, l2):
+    l1 = as_array(l1)
+    return l1[~contains(as_array(l2), l1)]